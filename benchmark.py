@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+  Time every stage of the pipeline on synthetic seismograms of several sizes,
+  and report how the time and peak memory of each stage grow with the number
+  of pixels. Each size is analyzed in a fresh process, with one stage running
+  at a time, so the timings and memory numbers of the stages are their own.
+
+  The results are saved as json. When the results of an earlier run are
+  given as a baseline, exits with status 1 if any stage got slower than
+  the baseline by more than the tolerance.
+
+Usage:
+  benchmark.py --output <filename> [--scales <scales>] [--traces <n>] [--amplitude <a>] [--crossings <c>] [--noise <sigma>] [--seed <seed>] [--baseline <filename>] [--tolerance <fraction>] [--min-seconds <seconds>] [--keep <directory>]
+  benchmark.py -h | --help
+
+Options:
+  -h --help                Show this screen.
+  --output <filename>      Save the results as json to <filename>.
+  --scales <scales>        Comma-separated sizes of the synthetic seismograms, with 1 for
+                           full-size, 0.25 for quarter-size, etc. [default: 0.125,0.177,0.25]
+  --traces <n>             Number of traces on each seismogram. [default: 24]
+  --amplitude <a>          Motion of the traces around their meanlines, in trace widths. [default: 1]
+  --crossings <c>          Average number of large, trace-crossing excursions per trace. [default: 0.5]
+  --noise <sigma>          Standard deviation of the noise added to the images. [default: 0.02]
+  --seed <seed>            Seed for the synthetic seismograms. [default: 0]
+  --baseline <filename>    Compare against the results saved by an earlier run.
+  --tolerance <fraction>   Fraction by which a stage may get slower before it counts
+                           as a regression. [default: 0.2]
+  --min-seconds <seconds>  Ignore slowdowns smaller than this many seconds. [default: 0.5]
+  --keep <directory>       Keep the synthetic seismograms and the metadata generated
+                           from them in <directory>.
+
+"""
+
+from docopt import docopt
+
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from multiprocessing import Process, Queue
+
+def run_scale(image_file, out_dir, scale, queue):
+  from get_all_metadata import analyze_image
+  from lib.timer import Tracer
+
+  status = analyze_image(image_file, out_dir, False, scale, fix_seed=True,
+                         num_threads=1, trace_file=out_dir + "/trace.json")
+
+  total_time = sum(span.wall_time for span in Tracer.spans
+                   if span.name == "get all metadata")
+  # ru_maxrss is in kilobytes on linux
+  peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  queue.put({
+    "status": status,
+    "total_time": float("%.4f" % total_time),
+    "peak_rss_mb": float("%.2f" % peak_rss_mb),
+    "stages": Tracer.get_stage_summary()
+  })
+
+def benchmark_scale(scale, work_dir, generator_params):
+  from lib.synthetic_seismogram import generate_seismogram
+  from skimage.io import imsave
+
+  image, truth = generate_seismogram(scale, **generator_params)
+  num_pixels = int(image.size)
+  image_file = os.path.join(work_dir, "synthetic-%s.png" % scale)
+  imsave(image_file, image)
+  image = None
+
+  out_dir = os.path.join(work_dir, "synthetic-%s" % scale)
+  queue = Queue()
+  process = Process(target=run_scale, args=(image_file, out_dir, scale, queue))
+  process.start()
+  result = queue.get()
+  process.join()
+
+  result["scale"] = scale
+  result["num_pixels"] = num_pixels
+  return result
+
+def get_growth(runs):
+  '''
+  Fits time ~ pixels^k and peak RSS delta ~ pixels^k for every stage
+  on a log-log scale, and returns the exponents k. An exponent near 1 means
+  the stage scales linearly with the number of pixels.
+  '''
+  import numpy as np
+
+  growth = {}
+  if len(runs) < 2:
+    return growth
+
+  log_pixels = np.log([ run["num_pixels"] for run in runs ])
+
+  def fit(values):
+    values = np.array(values, dtype=float)
+    if (values <= 0).any():
+      return None
+    return float("%.3f" % np.polyfit(log_pixels, np.log(values), 1)[0])
+
+  for stage in runs[0]["stages"]:
+    if not all(stage in run["stages"] for run in runs):
+      continue
+    growth[stage] = {
+      "time_exponent": fit([ run["stages"][stage]["wall_time"] for run in runs ]),
+      "memory_exponent": fit([ run["stages"][stage]["peak_rss_delta"] for run in runs ])
+    }
+  growth["total"] = {
+    "time_exponent": fit([ run["total_time"] for run in runs ]),
+    "memory_exponent": fit([ run["peak_rss_mb"] for run in runs ])
+  }
+  return growth
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+  '''
+  Returns a list of descriptions of the stages that are slower in
+  **results** than in **baseline**, matching runs up by scale.
+  '''
+  regressions = []
+  if results["params"] != baseline["params"]:
+    print("WARN: The baseline was run on seismograms generated with different parameters")
+
+  baseline_runs = { run["scale"]: run for run in baseline["runs"] }
+
+  for run in results["runs"]:
+    baseline_run = baseline_runs.get(run["scale"])
+    if baseline_run is None:
+      continue
+
+    times = [ (stage, run["stages"][stage]["wall_time"], baseline_run["stages"][stage]["wall_time"])
+              for stage in run["stages"] if stage in baseline_run["stages"] ]
+    times.append(("total", run["total_time"], baseline_run["total_time"]))
+
+    for stage, new_time, old_time in times:
+      if new_time > old_time * (1 + tolerance) and new_time - old_time > min_seconds:
+        regressions.append("scale %s, stage %s: %.2fs -> %.2fs" % (run["scale"], stage, old_time, new_time))
+
+  return regressions
+
+def benchmark(scales, generator_params, keep_dir=None):
+  '''
+  Runs the pipeline on a synthetic seismogram at each of **scales**.
+
+  Returns
+  --------
+  results : dict
+    The generator parameters, one entry per scale in "runs", with the
+    total time, peak RSS and per-stage times of that run, and the growth
+    exponents of every stage in "growth".
+  '''
+  work_dir = keep_dir or tempfile.mkdtemp(prefix="seismo-benchmark-")
+
+  try:
+    runs = []
+    for scale in scales:
+      runs.append(benchmark_scale(scale, work_dir, generator_params))
+  finally:
+    if keep_dir is None:
+      shutil.rmtree(work_dir)
+
+  return {
+    "params": generator_params,
+    "runs": runs,
+    "growth": get_growth(runs)
+  }
+
+if __name__ == '__main__':
+  arguments = docopt(__doc__)
+  out_file = arguments["--output"]
+  scales = [ float(scale) for scale in arguments["--scales"].split(",") ]
+  generator_params = {
+    "num_traces": int(arguments["--traces"]),
+    "amplitude": float(arguments["--amplitude"]),
+    "crossing_density": float(arguments["--crossings"]),
+    "noise": float(arguments["--noise"]),
+    "seed": int(arguments["--seed"])
+  }
+  baseline_file = arguments["--baseline"]
+  tolerance = float(arguments["--tolerance"])
+  min_seconds = float(arguments["--min-seconds"])
+  keep_dir = arguments["--keep"]
+
+  if out_file:
+    results = benchmark(scales, generator_params, keep_dir)
+    with open(out_file, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results["growth"], indent=2, sort_keys=True))
+
+    if baseline_file:
+      with open(baseline_file, "r") as f:
+        baseline = json.load(f)
+      regressions = find_regressions(results, baseline, tolerance, min_seconds)
+      for regression in regressions:
+        print("REGRESSION>>>%s<<<" % regression)
+      if regressions:
+        sys.exit(1)
+  else:
+    print(arguments)
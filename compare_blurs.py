@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+  Check the FFT gaussian blurs of lib/gaussian_blur.py against scipy's
+  direct convolution on one seismogram. The image is flattened the way
+  the pipeline flattens it before finding ridges. For each sigma of
+  find_ridges and each axis, reports the time of both blurs and the
+  largest difference between them, then finds the ridges with each and
+  counts the pixels where they differ.
+
+Usage:
+  compare_blurs.py --image <filename> [--scale <scale>] [--report <filename>]
+  compare_blurs.py -h | --help
+
+Options:
+  -h --help             Show this screen.
+  --image <filename>    Filename of seismogram.
+  --scale <scale>       1 for a full-size seismogram, 0.25 for quarter-size, etc. [default: 1]
+  --report <filename>   Also save the report as json to <filename>.
+
+"""
+
+from docopt import docopt
+
+import json
+import time
+
+def get_flattened_image(in_file, scale):
+  from lib.debug import Debug
+  from lib.load_image import get_grayscale_image, image_as_float
+  from lib.roi_detection import get_roi, corners_to_geojson
+  from lib.polygon_mask import mask_image
+  from lib.threshold import flatten_background
+
+  Debug.set_seed(1234567890)
+  img_gray = image_as_float(get_grayscale_image(in_file))
+  corners = get_roi(img_gray, scale=scale)
+  masked_image = mask_image(img_gray, corners_to_geojson(corners)["geometry"]["coordinates"][0])
+  return flatten_background(masked_image, prob_background=0.95,
+                            return_background=True, img_gray=img_gray)
+
+def time_call(function, *args, **kwargs):
+  start = time.time()
+  result = function(*args, **kwargs)
+  return (result, time.time() - start)
+
+def compare_blurs(in_file, scale=1):
+  import numpy as np
+  from scipy import ndimage
+  from lib import gaussian_blur
+  from lib.gaussian_blur import fft_gaussian_filter1d, get_kernel
+  from lib.ridge_detection import find_ridges, get_sigma_list, get_ridge_params
+
+  img, background = get_flattened_image(in_file, scale)
+  img = np.asarray(img)
+
+  report = { "blurs": [], "ridges": {} }
+  params = get_ridge_params(scale)
+  for sigma in get_sigma_list(params["min_sigma"], params["max_sigma"],
+                              params["sigma_ratio"], params["max_scales"]):
+    for axis in [0, 1]:
+      direct, direct_time = time_call(ndimage.gaussian_filter1d, img, sigma, axis=axis)
+      blurred, fft_time = time_call(fft_gaussian_filter1d, img, sigma, axis)
+      report["blurs"].append({
+        "sigma": float("%.4f" % sigma),
+        "radius": get_kernel(sigma)[1],
+        "axis": axis,
+        "direct_time": float("%.4f" % direct_time),
+        "fft_time": float("%.4f" % fft_time),
+        "max_abs_difference": float(np.amax(np.abs(blurred - direct)))
+      })
+
+  min_radius = gaussian_blur.PARAMS["fft-min-radius"]
+  try:
+    gaussian_blur.PARAMS["fft-min-radius"] = np.inf
+    (direct_h, direct_v), direct_time = time_call(find_ridges, img, background, scale)
+  finally:
+    gaussian_blur.PARAMS["fft-min-radius"] = min_radius
+  (ridges_h, ridges_v), ridges_time = time_call(find_ridges, img, background, scale)
+
+  report["ridges"] = {
+    "direct_time": float("%.4f" % direct_time),
+    "time": float("%.4f" % ridges_time),
+    "num_different_h": int((direct_h != ridges_h).sum()),
+    "num_different_v": int((direct_v != ridges_v).sum())
+  }
+  return report
+
+if __name__ == '__main__':
+  arguments = docopt(__doc__)
+  in_file = arguments["--image"]
+  scale = float(arguments["--scale"])
+  report_file = arguments["--report"]
+
+  if in_file:
+    report = compare_blurs(in_file, scale)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report_file:
+      with open(report_file, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    print(arguments)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+  Run the full pipeline on one seismogram twice, once with float64 images
+  and once in compact (float32) mode, and report how much the outputs of
+  each stage differ and how much peak memory each run needed.
+
+Usage:
+  compare_precision.py --image <filename> --output <directory> [--scale <scale>] [--report <filename>]
+  compare_precision.py -h | --help
+
+Options:
+  -h --help             Show this screen.
+  --image <filename>    Filename of seismogram.
+  --output <directory>  Save the metadata and stage outputs of both runs in <directory>,
+                        which should be empty (cached stages would skew the memory numbers).
+  --scale <scale>       1 for a full-size seismogram, 0.25 for quarter-size, etc. [default: 1]
+  --report <filename>   Also save the report as json to <filename>.
+
+"""
+
+from docopt import docopt
+
+import json
+import resource
+from multiprocessing import Process, Queue
+
+MODES = ["float64", "compact"]
+
+def run_mode(in_file, out_root, scale, compact, queue):
+  from get_all_metadata import analyze_image
+  from lib.stage_cache import StageCache
+
+  mode = MODES[int(compact)]
+  out_dir = out_root + "/" + mode
+  analyze_image(in_file, out_dir, out_dir + "/stats.json", scale,
+                fix_seed=True, cache_dir=out_root + "/cache", compact=compact)
+
+  paths = { stage: StageCache.get_path(stage) for stage in StageCache.versions }
+  # ru_maxrss is in kilobytes on linux
+  peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  queue.put((paths, peak_rss_mb))
+
+def run_in_subprocess(in_file, out_root, scale, compact):
+  # run each mode in a fresh process so that its peak memory is its own
+  queue = Queue()
+  process = Process(target=run_mode, args=(in_file, out_root, scale, compact, queue))
+  process.start()
+  result = queue.get()
+  process.join()
+  return result
+
+def compare_arrays(a, b):
+  if a.dtype == bool:
+    num_different = int((a != b).sum())
+    return {
+      "num_different": num_different,
+      "fraction_different": num_different / float(a.size)
+    }
+  else:
+    return {
+      "max_abs_difference": float(abs(a.astype(float) - b.astype(float)).max())
+    }
+
+def compare_stages(paths_64, paths_32):
+  import numpy as np
+
+  report = {}
+  for stage in paths_64:
+    with np.load(paths_64[stage]) as outputs_64, np.load(paths_32[stage]) as outputs_32:
+      for name in outputs_64.files:
+        if name == "__stats__":
+          continue
+        a, b = outputs_64[name], outputs_32[name]
+        if a.shape != b.shape:
+          report[stage + "." + name] = { "shapes": [a.shape, b.shape] }
+        else:
+          report[stage + "." + name] = compare_arrays(a, b)
+  return report
+
+def compare_precision(in_file, out_root, scale=1):
+  paths_64, peak_rss_64 = run_in_subprocess(in_file, out_root, scale, False)
+  paths_32, peak_rss_32 = run_in_subprocess(in_file, out_root, scale, True)
+
+  report = {
+    "peak_rss_mb": { "float64": peak_rss_64, "compact": peak_rss_32 },
+    "stages": compare_stages(paths_64, paths_32),
+    "stats": {}
+  }
+
+  stats = [ json.load(open(out_root + "/" + mode + "/stats.json")) for mode in MODES ]
+  for key in stats[0]:
+    if key.startswith("num_"):
+      report["stats"][key] = { mode: s[key][-1] for mode, s in zip(MODES, stats) }
+
+  return report
+
+if __name__ == '__main__':
+  arguments = docopt(__doc__)
+  in_file = arguments["--image"]
+  out_root = arguments["--output"]
+  scale = float(arguments["--scale"])
+  report_file = arguments["--report"]
+
+  if (in_file and out_root):
+    report = compare_precision(in_file, out_root, scale)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report_file:
+      with open(report_file, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+  else:
+    print(arguments)
@@ -5,7 +5,7 @@ Description:
   for a single seismogram.
 
 Usage:
-  pipeline.py --image <filename> --output <directory> [--stats <filename>] [--scale <scale>] [--debug <directory>] [--fix-seed]
+  pipeline.py --image <filename> --output <directory> [--stats <filename>] [--scale <scale>] [--debug <directory>] [--fix-seed] [--cache <directory>] [--tile-workers <n>] [--threads <n>] [--compact] [--trace <filename>] [--preview] [--max-ridge-scales <n>]
   pipeline.py -h | --help
 
 Options:
@@ -17,18 +17,48 @@ Options:
   --scale <scale>       1 for a full-size seismogram, 0.25 for quarter-size, etc. [default: 1]
   --debug <directory>   Save intermediate steps as images for inspection in <directory>.
   --fix-seed            Fix random seed.
+  --cache <directory>   Cache the outputs of the expensive early stages (ROI through skeleton)
+                        in <directory>, and reuse them when the same image is analyzed again
+                        with the same parameters.
+  --tile-workers <n>    Run ridge detection and binarization on overlapping tiles of the image
+                        in <n> worker processes. Tiled ridges match the whole image exactly;
+                        tiled binarization can differ near tile edges, since the watershed
+                        has no bounded reach (see tiling.binary_image_tiled).
+  --threads <n>         Run up to <n> independent pipeline stages at once (1 with --debug). [default: 4]
+  --compact             Keep images and threshold surfaces in float32 instead of float64,
+                        roughly halving peak memory. See compare_precision.py.
+  --trace <filename>    Save the nesting, wall time, CPU time and peak memory growth of every
+                        timed step to <filename> as a Chrome trace (open in chrome://tracing).
+  --preview             Check the ROI and meanlines of a low-resolution copy of the seismogram
+                        first, and mark it problematic without analyzing it further if they
+                        look wrong.
+  --max-ridge-scales <n>  Find ridges at no more than <n> scales, dropping the widest. By default
+                        the scales depend on --scale (see ridge_detection.PARAMS).
 
 """
 
 from docopt import docopt
 
-def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False, fix_seed=False):
+def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False,
+                  fix_seed=False, cache_dir=False, tile_workers=False, num_threads=4,
+                  compact=False, trace_file=False, preview=False, max_ridge_scales=None):
   from lib.dir import ensure_dir_exists
   from lib.debug import Debug
   from lib.stats_recorder import Record
+  from lib.stage_cache import StageCache, corners_to_array, array_to_corners
+  from lib.pipeline import Pipeline, Stage
+  from lib.precision import Precision
 
   if debug_dir:
     Debug.set_directory(debug_dir)
+    # debug images are numbered, and Debug.random is drawn from, in the
+    # order stages run, so debug runs keep to one thread
+    num_threads = 1
+
+  if cache_dir:
+    StageCache.set_directory(cache_dir)
+
+  Precision.set_compact(compact)
 
   if fix_seed:
     Debug.set_seed(1234567890)
@@ -36,9 +66,15 @@ def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False,
   if stats_file:
     Record.activate()
 
+  # stats from a previous image analyzed by this process
+  # (e.g. in a batch worker) must not leak into this record
+  Record.reset()
+
   ensure_dir_exists(out_dir)
 
-  from lib.timer import timeStart, timeEnd
+  from lib.timer import timeStart, timeEnd, Tracer
+
+  Tracer.reset()
 
   from lib.load_image import get_grayscale_image, image_as_float
   from skimage.morphology import medial_axis
@@ -48,13 +84,22 @@ def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False,
   from lib.threshold import flatten_background
   from lib.ridge_detection import find_ridges
   from lib.binarization import binary_image
+  from lib.tiling import find_ridges_tiled, binary_image_tiled
+  from lib.sparse_ridges import SparseRidges
   from lib.intersection_detection import find_intersections
   from lib.trace_segmentation import get_segments, segments_to_geojson
   from lib.geojson_io import save_features, save_json
   from lib.utilities import encode_labeled_image_as_rgb
+  from lib.preview import preview_scan
+  from lib.quantized_image import QuantizedImage
+  from lib.feature_bank import FeatureBank
   from scipy import misc
   import numpy as np
 
+  # images quantized and filtered for a previous image analyzed by this process
+  QuantizedImage.reset()
+  FeatureBank.reset()
+
   paths = {
     "roi": out_dir+"/roi.json",
     "meanlines": out_dir+"/meanlines.json",
@@ -67,142 +112,244 @@ def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False,
 
   timeStart("get all metadata")
 
+  StageCache.set_image(in_file)
+  StageCache.register("roi", { "scale": scale, "compact": compact })
+  StageCache.register("meanlines", { "scale": scale }, parent="roi")
+  StageCache.register("flatten", { "prob_background": 0.95 }, parent="roi")
+  StageCache.register("ridges", { "scale": scale, "max_scales": max_ridge_scales },
+                      parent="flatten")
+  # tiled binarization can differ from the whole image's near tile edges
+  StageCache.register("binary", { "tiled": bool(tile_workers) }, parent="ridges")
+  StageCache.register("skeleton", {}, parent="binary")
+
   timeStart("read image")
   img_gray = image_as_float(get_grayscale_image(in_file))
   timeEnd("read image")
 
-  print("\n--ROI--")
-  timeStart("get region of interest")
-  corners = get_roi(img_gray, scale=scale)
-  timeEnd("get region of interest")
-
-  timeStart("convert roi to geojson")
-  corners_as_geojson = corners_to_geojson(corners)
-  timeEnd("convert roi to geojson")
-
-  timeStart("saving roi as geojson")
-  save_features(corners_as_geojson, paths["roi"])
-  timeEnd("saving roi as geojson")
-
-
-  print("\n--MASK IMAGE--")
-  roi_polygon = corners_as_geojson["geometry"]["coordinates"][0]
-
-  timeStart("mask image")
-  masked_image = mask_image(img_gray, roi_polygon)
-  timeEnd("mask image")
-
-  Debug.save_image("main", "masked_image", masked_image.filled(0))
-
-  if Record.active:
-    non_masked_values = 255 * masked_image.compressed()
-    bins = np.arange(257)
-    image_hist, _ = np.histogram(non_masked_values, bins=bins)
-    Record.record("roi_intensity_hist", image_hist.tolist())
-
-
-  print("\n--MEANLINES--")
-  meanlines = detect_meanlines(masked_image, corners, scale=scale)
+  def finish(status):
+    time_elapsed = timeEnd("get all metadata")
 
-  timeStart("convert meanlines to geojson")
-  meanlines_as_geojson = meanlines_to_geojson(meanlines)
-  timeEnd("convert meanlines to geojson")
+    Record.record("time_elapsed", float("%.2f" % time_elapsed))
+    Record.record("stage_times", Tracer.get_stage_summary())
 
-  timeStart("saving meanlines as geojson")
-  save_features(meanlines_as_geojson, paths["meanlines"])
-  timeEnd("saving meanlines as geojson")
+    if (trace_file):
+      Tracer.export_chrome_trace(trace_file)
 
+    if (stats_file):
+      Record.export_as_json(stats_file)
 
-  print("\n--FLATTEN BACKGROUND--")
-  img_dark_removed, background = \
-    flatten_background(masked_image, prob_background=0.95,
-                       return_background=True, img_gray=img_gray)
+    print("STATUS>>>%s<<<" % status)
+    return status
 
-  Debug.save_image("main", "flattened_background", img_dark_removed)
+  if preview:
+    print("\n--PREVIEW--")
+    timeStart("preview")
+    passed = preview_scan(img_gray, scale)
+    timeEnd("preview")
 
-  masked_image = None
+    if not passed:
+      print("==> Preview failed quality control. Skipping the rest of the pipeline.")
+      return finish("problematic")
 
-  print("\n--RIDGES--")
-  timeStart("get horizontal and vertical ridges")
-  ridges_h, ridges_v = find_ridges(img_dark_removed, background)
-  ridges = ridges_h | ridges_v
-  timeEnd("get horizontal and vertical ridges")
+  def roi(img_gray):
+    print("\n--ROI--")
+    timeStart("get region of interest")
+    corners = get_roi(img_gray, scale=scale)
+    timeEnd("get region of interest")
 
+    return corners_to_array(corners)
 
-  print("\n--THRESHOLDING--")
-  timeStart("get binary image")
-  img_bin = binary_image(img_dark_removed, markers_trace=ridges,
-               markers_background=background)
-  timeEnd("get binary image")
+  def roi_to_geojson(roi_corners):
+    corners = array_to_corners(roi_corners)
 
-  img_dark_removed = None
-  background = None
+    timeStart("convert roi to geojson")
+    corners_as_geojson = corners_to_geojson(corners)
+    timeEnd("convert roi to geojson")
 
-  print("\n--SKELETONIZE--")
-  timeStart("get medial axis skeleton and distance transform")
-  img_skel, dist = medial_axis(img_bin, return_distance=True)
-  timeEnd("get medial axis skeleton and distance transform")
+    return (corners, corners_as_geojson)
 
-  Debug.save_image("skeletonize", "skeleton", img_skel)
+  def save_roi(corners_as_geojson):
+    timeStart("saving roi as geojson")
+    save_features(corners_as_geojson, paths["roi"])
+    timeEnd("saving roi as geojson")
 
+  def mask(img_gray, corners_as_geojson):
+    print("\n--MASK IMAGE--")
+    roi_polygon = corners_as_geojson["geometry"]["coordinates"][0]
 
-  print("\n--INTERSECTIONS--")
-  intersections = find_intersections(img_bin, img_skel, dist, figure=False)
+    timeStart("mask image")
+    masked_image = mask_image(img_gray, roi_polygon)
+    timeEnd("mask image")
 
-  timeStart("convert to geojson")
-  intersection_json = intersections.asGeoJSON()
-  timeEnd("convert to geojson")
+    Debug.save_image("main", "masked_image", masked_image.filled(0))
 
-  timeStart("saving intersections as geojson")
-  save_features(intersection_json, paths["intersections"])
-  timeEnd("saving intersections as geojson")
+    return masked_image
 
-  timeStart("convert to image")
-  intersection_image = intersections.asImage()
-  timeEnd("convert to image")
-
-  Debug.save_image("intersections", "intersections", intersection_image)
-  timeStart("save intersections raster")
-  misc.imsave(paths["intersections_raster"], intersection_image)
-  timeEnd("save intersections raster")
-
-  print("\n--SEGMENTS--")
-  timeStart("get segments")
-  segments, labeled_regions = \
-    get_segments(img_gray, img_bin, img_skel, dist, intersection_image,
-                 ridges_h, ridges_v, figure=True)
-  timeEnd("get segments")
-
-  timeStart("encode labels as rgb values")
-  rgb_segments = encode_labeled_image_as_rgb(labeled_regions)
-  timeEnd("encode labels as rgb values")
-
-  timeStart("save segment regions")
-  misc.imsave(paths["segment_regions"], rgb_segments)
-  timeEnd("save segment regions")
-
-  timeStart("convert centerlines to geojson")
-  segments_as_geojson = segments_to_geojson(segments)
-  timeEnd("convert centerlines to geojson")
-
-  timeStart("saving centerlines as geojson")
-  save_features(segments_as_geojson, paths["segments"])
-  timeEnd("saving centerlines as geojson")
-
-  #return (img_gray, ridges, img_bin, intersections, img_seg)
-  # return segments
-  # detect center lines
-
-  # connect segments
-
-  # output data
-
-  time_elapsed = timeEnd("get all metadata")
-
-  Record.record("time_elapsed", float("%.2f" % time_elapsed))
+  def roi_stats(masked_image):
+    # the meanline and flatten stages quantize the masked image too,
+    # through the same QuantizedImage
+    timeStart("get roi intensity histogram")
+    image_hist = QuantizedImage.of(masked_image).get_histogram()
+    Record.record("roi_intensity_hist", image_hist.tolist())
+    timeEnd("get roi intensity histogram")
+
+  def meanlines(masked_image, corners):
+    print("\n--MEANLINES--")
+    lines = detect_meanlines(masked_image, corners, scale=scale)
+    return np.asarray(lines).reshape(-1, 2, 2)
+
+  def save_meanlines(meanline_coords):
+    timeStart("convert meanlines to geojson")
+    meanlines_as_geojson = meanlines_to_geojson(meanline_coords.tolist())
+    timeEnd("convert meanlines to geojson")
+
+    timeStart("saving meanlines as geojson")
+    save_features(meanlines_as_geojson, paths["meanlines"])
+    timeEnd("saving meanlines as geojson")
+
+  def flatten(masked_image, img_gray):
+    print("\n--FLATTEN BACKGROUND--")
+    img_dark_removed, background = \
+      flatten_background(masked_image, prob_background=0.95,
+                         return_background=True, img_gray=img_gray)
+
+    Debug.save_image("main", "flattened_background", img_dark_removed)
+
+    return (img_dark_removed, background)
+
+  def ridges(img_dark_removed, background):
+    print("\n--RIDGES--")
+    timeStart("get horizontal and vertical ridges")
+    # the ridges are kept as lists of pixels (see SparseRidges)
+    if tile_workers:
+      ridges_h, ridges_v = find_ridges_tiled(img_dark_removed, background,
+                                             num_processes=tile_workers, figures=False,
+                                             scale=scale, max_scales=max_ridge_scales)
+    else:
+      ridges_h, ridges_v = find_ridges(img_dark_removed, background, figures=False,
+                                       scale=scale, max_scales=max_ridge_scales)
+    timeEnd("get horizontal and vertical ridges")
+    return (ridges_h, ridges_v)
+
+  def binary(img_dark_removed, background, ridges_h, ridges_v):
+    print("\n--THRESHOLDING--")
+    timeStart("get binary image")
+    markers_trace = SparseRidges(ridges_h, img_dark_removed.shape).to_image() | \
+                    SparseRidges(ridges_v, img_dark_removed.shape).to_image()
+    if tile_workers:
+      img_bin = binary_image_tiled(img_dark_removed, markers_trace, background,
+                                   num_processes=tile_workers, scale=scale,
+                                   max_scales=max_ridge_scales)
+    else:
+      img_bin = binary_image(img_dark_removed, markers_trace=markers_trace,
+                   markers_background=background)
+    timeEnd("get binary image")
+    return img_bin
+
+  def skeleton(img_bin):
+    print("\n--SKELETONIZE--")
+    timeStart("get medial axis skeleton and distance transform")
+    img_skel, dist = medial_axis(img_bin, return_distance=True)
+    dist = Precision.as_float(dist)
+    timeEnd("get medial axis skeleton and distance transform")
+
+    Debug.save_image("skeletonize", "skeleton", img_skel)
+
+    return (img_skel, dist)
+
+  def intersections(img_bin, img_skel, dist):
+    print("\n--INTERSECTIONS--")
+    return find_intersections(img_bin, img_skel, dist, figure=False)
+
+  def save_intersections(intersections):
+    timeStart("convert to geojson")
+    intersection_json = intersections.asGeoJSON()
+    timeEnd("convert to geojson")
+
+    timeStart("saving intersections as geojson")
+    save_features(intersection_json, paths["intersections"])
+    timeEnd("saving intersections as geojson")
+
+  def intersections_to_image(intersections):
+    timeStart("convert to image")
+    intersection_image = intersections.asImage()
+    timeEnd("convert to image")
+
+    Debug.save_image("intersections", "intersections", intersection_image)
+    return intersection_image
+
+  def save_intersection_image(intersection_image):
+    timeStart("save intersections raster")
+    misc.imsave(paths["intersections_raster"], intersection_image)
+    timeEnd("save intersections raster")
+
+  def segments(img_gray, img_bin, img_skel, dist, intersection_image,
+               ridges_h, ridges_v):
+    print("\n--SEGMENTS--")
+    timeStart("get segments")
+    segments, labeled_regions = \
+      get_segments(img_gray, img_bin, img_skel, dist, intersection_image,
+                   SparseRidges(ridges_h, img_gray.shape),
+                   SparseRidges(ridges_v, img_gray.shape), figure=True)
+    timeEnd("get segments")
+    return (segments, labeled_regions)
+
+  def save_segment_regions(labeled_regions):
+    timeStart("encode labels as rgb values")
+    rgb_segments = encode_labeled_image_as_rgb(labeled_regions)
+    timeEnd("encode labels as rgb values")
+
+    timeStart("save segment regions")
+    misc.imsave(paths["segment_regions"], rgb_segments)
+    timeEnd("save segment regions")
+
+  def save_segments(segments):
+    timeStart("convert centerlines to geojson")
+    segments_as_geojson = segments_to_geojson(segments)
+    timeEnd("convert centerlines to geojson")
+
+    timeStart("saving centerlines as geojson")
+    save_features(segments_as_geojson, paths["segments"])
+    timeEnd("saving centerlines as geojson")
+
+  pipeline = Pipeline([
+    Stage("roi", roi, ["img_gray"], ["roi_corners"], cached=True),
+    Stage("roi_to_geojson", roi_to_geojson, ["roi_corners"], ["corners", "corners_as_geojson"]),
+    Stage("save_roi", save_roi, ["corners_as_geojson"]),
+    Stage("mask", mask, ["img_gray", "corners_as_geojson"], ["masked_image"]),
+    Stage("roi_stats", roi_stats, ["masked_image"]),
+    Stage("meanlines", meanlines, ["masked_image", "corners"], ["meanline_coords"], cached=True),
+    Stage("save_meanlines", save_meanlines, ["meanline_coords"]),
+    Stage("flatten", flatten, ["masked_image", "img_gray"],
+          ["img_dark_removed", "background"], cached=True),
+    Stage("ridges", ridges, ["img_dark_removed", "background"],
+          ["ridges_h", "ridges_v"], cached=True),
+    Stage("binary", binary, ["img_dark_removed", "background", "ridges_h", "ridges_v"],
+          ["img_bin"], cached=True),
+    Stage("skeleton", skeleton, ["img_bin"], ["img_skel", "dist"], cached=True),
+    Stage("intersections", intersections, ["img_bin", "img_skel", "dist"], ["intersections"]),
+    Stage("save_intersections", save_intersections, ["intersections"]),
+    Stage("intersections_to_image", intersections_to_image, ["intersections"],
+          ["intersection_image"]),
+    Stage("save_intersection_image", save_intersection_image, ["intersection_image"]),
+    Stage("segments", segments, ["img_gray", "img_bin", "img_skel", "dist", "intersection_image",
+                                 "ridges_h", "ridges_v"], ["segments", "labeled_regions"]),
+    Stage("save_segment_regions", save_segment_regions, ["labeled_regions"]),
+    Stage("save_segments", save_segments, ["segments"])
+  ])
+
+  targets = ["save_roi", "save_meanlines", "save_intersections",
+             "save_intersection_image", "save_segment_regions",
+             "save_segments", "segments"]
+  # the mask stage isn't cached, so the roi stats are recorded on every
+  # run with stats, even when the stages after the mask are cached
+  if Record.active:
+    targets.append("roi_stats")
 
-  if (stats_file):
-    Record.export_as_json(stats_file)
+  results = pipeline.run({ "img_gray": img_gray }, targets=targets,
+                         num_threads=num_threads)
+  img_gray = None
+  segments = results["segments"]
 
   # TODO: refactor this into some sort of status module.
   # For now, since this is our only problematic status,
@@ -211,9 +358,11 @@ def analyze_image(in_file, out_dir, stats_file=False, scale=1, debug_dir=False,
   # for specific conditions.
   max_segments_reasonable = 11000
   if (len(segments) > max_segments_reasonable):
-    print("STATUS>>>problematic<<<")
+    status = "problematic"
   else:
-    print("STATUS>>>complete<<<")
+    status = "complete"
+
+  return finish(status)
 
 if __name__ == '__main__':
   arguments = docopt(__doc__)
@@ -223,8 +372,23 @@ if __name__ == '__main__':
   scale = float(arguments["--scale"])
   debug_dir = arguments["--debug"]
   fix_seed = arguments["--fix-seed"]
+  cache_dir = arguments["--cache"]
+  tile_workers = arguments["--tile-workers"]
+  num_threads = int(arguments["--threads"])
+  compact = arguments["--compact"]
+  trace_file = arguments["--trace"]
+  preview = arguments["--preview"]
+  max_ridge_scales = arguments["--max-ridge-scales"]
+
+  if tile_workers is not None:
+    tile_workers = int(tile_workers)
+
+  if max_ridge_scales is not None:
+    max_ridge_scales = int(max_ridge_scales)
 
   if (in_file and out_dir):
-    segments = analyze_image(in_file, out_dir, stats_file, scale, debug_dir, fix_seed)
+    status = analyze_image(in_file, out_dir, stats_file, scale, debug_dir, fix_seed,
+                           cache_dir, tile_workers, num_threads, compact, trace_file, preview,
+                           max_ridge_scales)
   else:
     print(arguments)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+  Generate all metadata for many seismograms with a pool of long-lived
+  worker processes. Each worker imports the pipeline once and then calls
+  analyze_image for every seismogram it is handed, so the cost of importing
+  scipy, skimage, cv2, matplotlib, etc. is paid once per worker rather than
+  once per image. The CPUs are divided between the workers, so each one
+  runs the pipeline with (number of CPUs / number of workers) threads.
+
+  Metadata for each seismogram is saved in <directory>/<image name>/, along
+  with a stats.json record for that seismogram.
+
+Usage:
+  get_all_metadata_batch.py --images <path> --output <directory> [--processes <n>] [--scale <scale>] [--fix-seed] [--cache <directory>] [--compact] [--trace] [--preview]
+  get_all_metadata_batch.py -h | --help
+
+Options:
+  -h --help             Show this screen.
+  --images <path>       Either a directory of seismograms (every .png inside is processed),
+                        or a text file listing one seismogram path per line.
+  --output <directory>  Save metadata in <directory>/<image name>.
+  --processes <n>       Number of worker processes. Defaults to the number of CPUs.
+  --scale <scale>       1 for a full-size seismogram, 0.25 for quarter-size, etc. [default: 1]
+  --fix-seed            Fix random seed (reset for every image).
+  --cache <directory>   Cache intermediate stage outputs in <directory> (see get_all_metadata.py).
+  --compact             Use float32 images (see get_all_metadata.py).
+  --trace               Save a Chrome trace of each seismogram to <directory>/<image name>/trace.json.
+  --preview             Reject bad seismograms early (see get_all_metadata.py).
+
+"""
+
+from docopt import docopt
+
+import os
+import traceback
+from multiprocessing import Pool, cpu_count
+
+def list_images(path):
+  '''
+  Returns the seismogram filenames found in **path**, which can be
+  a directory of .png files or a text file with one filename per line.
+  '''
+  if os.path.isdir(path):
+    filenames = [ os.path.join(path, f) for f in sorted(os.listdir(path))
+                  if f.lower().endswith(".png") ]
+  else:
+    with open(path, "r") as f:
+      filenames = [ line.strip() for line in f.readlines() ]
+  return [ f for f in filenames if f ]
+
+def get_image_name(filename):
+  return os.path.splitext(os.path.basename(filename))[0]
+
+def warm_up():
+  # Import the whole pipeline once, when the worker starts. Every later
+  # call to analyze_image finds these modules in sys.modules.
+  import get_all_metadata
+  import lib.roi_detection
+  import lib.meanline_detection
+  import lib.threshold
+  import lib.ridge_detection
+  import lib.binarization
+  import lib.intersection_detection
+  import lib.trace_segmentation
+
+def get_threads_per_process(num_processes):
+  '''
+  Splits the CPUs between **num_processes** worker processes, so that
+  the pipeline threads of all the workers together don't outnumber them.
+  '''
+  return max(1, cpu_count() // num_processes)
+
+def process_image(task):
+  from get_all_metadata import analyze_image
+
+  in_file, out_root, scale, fix_seed, cache_dir, compact, trace, preview, num_threads = task
+  out_dir = os.path.join(out_root, get_image_name(in_file))
+  stats_file = os.path.join(out_dir, "stats.json")
+  trace_file = os.path.join(out_dir, "trace.json") if trace else False
+
+  try:
+    status = analyze_image(in_file, out_dir, stats_file, scale, False, fix_seed,
+                           cache_dir, num_threads=num_threads, compact=compact,
+                           trace_file=trace_file, preview=preview)
+    return (in_file, status, None)
+  except Exception:
+    return (in_file, "failed", traceback.format_exc())
+
+def analyze_images(filenames, out_root, num_processes=None, scale=1, fix_seed=False,
+                   cache_dir=False, compact=False, trace=False, preview=False):
+  '''
+  Runs analyze_image on every file in **filenames** using a pool of
+  **num_processes** worker processes.
+
+  Returns
+  --------
+  statuses : dict
+    Maps each filename to "complete", "problematic", or "failed".
+  '''
+  if num_processes is None:
+    num_processes = cpu_count()
+
+  num_threads = get_threads_per_process(num_processes)
+  tasks = [ (in_file, out_root, scale, fix_seed, cache_dir, compact, trace, preview, num_threads)
+            for in_file in filenames ]
+  statuses = {}
+
+  pool = Pool(processes=num_processes, initializer=warm_up)
+  try:
+    # chunksize=1 so a slow seismogram never holds a queue of other
+    # seismograms hostage on its worker
+    for (i, (in_file, status, error)) in \
+        enumerate(pool.imap_unordered(process_image, tasks, chunksize=1)):
+      statuses[in_file] = status
+      if error is not None:
+        print(error)
+      print("BATCH>>>%s of %s: %s %s<<<" % (i + 1, len(tasks), in_file, status))
+  finally:
+    pool.close()
+    pool.join()
+
+  return statuses
+
+if __name__ == '__main__':
+  arguments = docopt(__doc__)
+  images_path = arguments["--images"]
+  out_root = arguments["--output"]
+  num_processes = arguments["--processes"]
+  scale = float(arguments["--scale"])
+  fix_seed = arguments["--fix-seed"]
+  cache_dir = arguments["--cache"]
+  compact = arguments["--compact"]
+  trace = arguments["--trace"]
+  preview = arguments["--preview"]
+
+  if num_processes is not None:
+    num_processes = int(num_processes)
+
+  if (images_path and out_root):
+    filenames = list_images(images_path)
+    analyze_images(filenames, out_root, num_processes, scale, fix_seed, cache_dir,
+                   compact, trace, preview)
+  else:
+    print(arguments)
@@ -11,10 +11,10 @@ from skimage import color
 from scipy.signal import convolve2d
 from skimage.morphology import remove_small_objects
 from skimage.segmentation import watershed
-from skimage.filters import sobel
 from skimage.feature import canny
 
 from .threshold import background_threshold
+from .feature_bank import FeatureBank, get_sobel_magnitude
 from .ridge_detection import find_ridges
 
 def binary_image(image, markers_trace=None, markers_background=None,
@@ -78,13 +78,15 @@ def watershed_segmentation(image_gray, markers_trace, markers_background,
     A 2-D array with the same shape as the input image. Foreground pixels
     are True, and background pixels are False.
   '''
-  bin_markers = np.zeros_like(image_gray, dtype=int)
-  bin_markers = np.where(markers_trace, 2, 0)
-  bin_markers = np.where(markers_background, 1, bin_markers)
+  bin_markers = np.where(markers_trace, np.uint8(2), np.uint8(0))
+  bin_markers = np.where(markers_background, np.uint8(1), bin_markers)
 
-  image_sobel = sobel(image_gray)
+  image_sobel = get_sobel_magnitude(image_gray)
+  # the watershed is the last consumer of the slopes ridge detection shares
+  FeatureBank.release("sobel-axis", image_gray, axis=0)
+  FeatureBank.release("sobel-axis", image_gray, axis=1)
   image_canny = canny(image_gray)
-  edges = np.maximum(image_canny.astype(float), image_sobel)
+  edges = np.maximum(image_canny.astype(image_sobel.dtype), image_sobel)
 
   image_bin = watershed(edges, bin_markers)
   image_bin = image_bin == 2
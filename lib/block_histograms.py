@@ -0,0 +1,106 @@
+import numpy as np
+
+from .quantized_image import QuantizedImage
+
+class IntegralHistogram:
+  '''
+  Cumulative 256-bin histograms of an image on a grid of square cells.
+
+  The histogram of a block is the histogram of the whole cells inside it,
+  read off the cumulative histograms in constant time, plus the counts of
+  the strips of partial cells around its edges. So the histogram is exact,
+  and the cost of a block grows with its perimeter times the cell size,
+  not with its area.
+
+  Attributes
+  -------------
+  cell_size : int
+  shape : tuple
+    The dimensions of the image.
+  levels : 2-D numpy array of uint8
+    The quantized image (see QuantizedImage).
+  mask : 2-D numpy array of bools, or None
+  integral : 3-D numpy array of int32
+    integral[i, j] is the histogram of the image above row
+    i * cell_size and left of column j * cell_size.
+  bin_edges : 1-D numpy array
+  '''
+  def __init__(self, img, cell_size):
+    quantized = QuantizedImage.of(img)
+    self.levels, self.mask, self.bin_edges = \
+      quantized.levels, quantized.mask, quantized.bin_edges
+    self.cell_size = cell_size
+    self.shape = img.shape
+
+    num_cell_rows = -(-self.shape[0] // cell_size)
+    num_cell_cols = -(-self.shape[1] // cell_size)
+
+    # histogram one row of cells at a time, keyed by cell column and
+    # level, so no full-size array of keys is ever built
+    col_keys = (np.arange(self.shape[1], dtype=np.int32) // cell_size) * 256
+    cells = np.zeros((num_cell_rows, num_cell_cols, 256), dtype=np.int32)
+    for i in range(num_cell_rows):
+      rows = slice(i * cell_size, (i + 1) * cell_size)
+      keys = col_keys + self.levels[rows]
+      if self.mask is not None:
+        keys = keys[~self.mask[rows]]
+      cells[i] = np.bincount(keys.ravel(), minlength=num_cell_cols * 256) \
+                   .reshape((num_cell_cols, 256))
+
+    self.integral = np.zeros((num_cell_rows + 1, num_cell_cols + 1, 256), dtype=np.int32)
+    np.cumsum(cells, axis=0, out=self.integral[1:, 1:])
+    np.cumsum(self.integral[1:, 1:], axis=1, out=self.integral[1:, 1:])
+
+  def get_cell_range(self, start, stop, axis):
+    '''
+    Returns the first and last (exclusive) cells that lie entirely within
+    [start, stop) along **axis**, and the pixel boundaries of those cells.
+    '''
+    first = -(-start // self.cell_size)
+    if stop >= self.shape[axis]:
+      last = self.integral.shape[axis] - 1
+    else:
+      last = stop // self.cell_size
+    last = max(first, last)
+    return (first, last,
+            min(first * self.cell_size, self.shape[axis]),
+            min(last * self.cell_size, self.shape[axis]))
+
+  def count(self, rows, cols):
+    levels = self.levels[rows, cols]
+    if self.mask is not None:
+      levels = levels[~self.mask[rows, cols]]
+    return np.bincount(levels.ravel(), minlength=256)
+
+  def get_histogram(self, upper, lower, left, right):
+    '''
+    Returns the histogram of the pixels in rows [upper, lower)
+    and columns [left, right).
+    '''
+    i0, i1, top, bottom = self.get_cell_range(upper, lower, 0)
+    j0, j1, start, stop = self.get_cell_range(left, right, 1)
+
+    if i1 == i0 or j1 == j0:
+      # the block is too thin to contain a whole cell
+      return self.count(slice(upper, lower), slice(left, right))
+
+    integral = self.integral
+    hist = integral[i1, j1] - integral[i0, j1] - integral[i1, j0] + integral[i0, j0]
+
+    # the partial cells above, below, left of and right of the whole cells
+    hist += self.count(slice(upper, top), slice(left, right))
+    hist += self.count(slice(bottom, lower), slice(left, right))
+    hist += self.count(slice(top, bottom), slice(left, start))
+    hist += self.count(slice(top, bottom), slice(stop, right))
+    return hist
+
+  def get_block_histogram(self, center, block_dims):
+    '''
+    Returns the histogram of the block of **img** that
+    threshold.get_block(img, center, block_dims) would return.
+    '''
+    upper = int(max(0, center[0] - block_dims[0] / 2))
+    lower = int(min(self.shape[0], center[0] + block_dims[0] / 2 + 1))
+    left = int(max(0, center[1] - block_dims[1] / 2))
+    right = int(min(self.shape[1], center[1] + block_dims[1] / 2 + 1))
+    return self.get_histogram(upper, lower, left, right)
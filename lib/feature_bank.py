@@ -0,0 +1,97 @@
+'''
+Filters of an image computed once per run, for the stages that share them.
+
+Ridge detection thresholds the Sobel slopes of the flattened image along
+each axis, and binarization floods the Sobel magnitude of that same
+image, which is made of those two slopes. Asking FeatureBank for the
+slopes computes them the first time and returns the same arrays after
+that, until their last consumer releases them.
+
+'''
+
+import threading
+import weakref
+
+import numpy as np
+from skimage import filters
+
+def get_sobel_magnitude(img):
+  '''
+  skimage.filters.sobel(img), from the slopes along each axis in the
+  bank, adding them up in the same order so the result is identical.
+  '''
+  slopes_0 = FeatureBank.get("sobel-axis", img, axis=0)
+  slopes_1 = FeatureBank.get("sobel-axis", img, axis=1)
+  magnitude = slopes_0 * slopes_0
+  magnitude += slopes_1 * slopes_1
+  return np.sqrt(magnitude) / np.sqrt(2, dtype=magnitude.dtype)
+
+FEATURES = {
+  # skimage's Sobel filter along one axis, which is ndimage.sobel / 4
+  # up to rounding
+  "sobel-axis": lambda img, axis: filters.sobel(img, axis=axis)
+}
+
+class FeatureBank:
+  '''
+  The features (see FEATURES) of the images of a run, each computed once.
+
+  A feature is kept until its last consumer releases it (see release),
+  or until the image it was computed from is collected, whichever comes
+  first. Images must not be modified in place once their features have
+  been asked for.
+  '''
+  # id of an image -> (weak reference to the image, {key: Feature})
+  images = {}
+  # reentrant, since an image can be collected (and forgotten) while
+  # the lock is held
+  lock = threading.RLock()
+
+  @classmethod
+  def reset(cls):
+    with cls.lock:
+      cls.images = {}
+
+  @classmethod
+  def get(cls, name, img, **params):
+    '''
+    Returns the feature **name** of **img**, computed with **params**.
+    '''
+    key = (name, tuple(sorted(params.items())))
+    with cls.lock:
+      ref, features = cls.images.get(id(img), (None, None))
+      if ref is None or ref() is not img:
+        features = {}
+        cls.images[id(img)] = (weakref.ref(img, cls.forget(id(img))), features)
+      feature = features.setdefault(key, Feature())
+
+    # concurrent requests for the same feature wait for the first one
+    with feature.lock:
+      if feature.value is None:
+        feature.value = FEATURES[name](img, **params)
+      return feature.value
+
+  @classmethod
+  def release(cls, name, img, **params):
+    '''
+    Drops the feature **name** of **img**, computed with **params**, once
+    nothing else needs it. Asking for it again computes it again.
+    '''
+    key = (name, tuple(sorted(params.items())))
+    with cls.lock:
+      ref, features = cls.images.get(id(img), (None, None))
+      if ref is not None and ref() is img:
+        features.pop(key, None)
+
+  @classmethod
+  def forget(cls, image_id):
+    def callback(ref):
+      with cls.lock:
+        if cls.images.get(image_id, (None,))[0] is ref:
+          del cls.images[image_id]
+    return callback
+
+class Feature:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.value = None
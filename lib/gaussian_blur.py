@@ -0,0 +1,75 @@
+'''
+Gaussian blurs along one axis of an image, with a cost that hardly grows
+with sigma.
+
+scipy's gaussian_filter1d convolves directly with a kernel about 8 sigma
+wide, so the widest blurs of the difference of gaussians in
+ridge_detection dominate its time. Above a kernel radius of
+PARAMS["fft-min-radius"], the same kernel (truncated at the same 4 sigma)
+is applied in the frequency domain instead, to the image padded the way
+gaussian_filter1d pads it ("reflect"). The result is the same convolution
+up to rounding errors (see get_blur_error), unlike recursive Gaussian
+approximations, whose errors are as big as the ridge thresholds.
+
+'''
+
+import numpy as np
+from scipy import fft
+from scipy import ndimage
+
+PARAMS = {
+  # the direct convolution is faster for smaller kernels
+  "fft-min-radius": 40,
+  # the size of the spectra transformed at once
+  "fft-chunk-bytes": 64 * 2**20
+}
+
+def get_kernel(sigma, truncate=4.0):
+  '''
+  The kernel of gaussian_filter1d, and its radius.
+  '''
+  radius = int(truncate * float(sigma) + 0.5)
+  x = np.arange(-radius, radius + 1)
+  kernel = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+  return (kernel / kernel.sum(), radius)
+
+def fft_gaussian_filter1d(img, sigma, axis, truncate=4.0):
+  '''
+  Equivalent to scipy.ndimage.gaussian_filter1d(img, sigma, axis) for a
+  2-D image, computed with FFTs a band of lines at a time.
+  '''
+  kernel, radius = get_kernel(sigma, truncate)
+  img = np.moveaxis(np.asarray(img), axis, 0)
+  length = img.shape[0]
+
+  # long enough for the padded lines not to wrap around
+  num_samples = fft.next_fast_len(length + 4 * radius, real=True)
+  kernel_spectrum = fft.rfft(kernel, num_samples)[:, np.newaxis]
+
+  blurred = np.empty(img.shape, dtype=img.dtype)
+  band = max(1, PARAMS["fft-chunk-bytes"] // (16 * num_samples))
+  for start in range(0, img.shape[1], band):
+    lines = np.pad(img[:, start:start + band], ((radius, radius), (0, 0)), mode="symmetric")
+    spectrum = fft.rfft(lines, num_samples, axis=0)
+    spectrum *= kernel_spectrum
+    convolved = fft.irfft(spectrum, num_samples, axis=0)
+    blurred[:, start:start + band] = convolved[2 * radius:2 * radius + length]
+
+  return np.moveaxis(blurred, 0, axis)
+
+def gaussian_filter1d(img, sigma, axis, truncate=4.0):
+  '''
+  scipy.ndimage.gaussian_filter1d, switching to fft_gaussian_filter1d
+  for wide kernels.
+  '''
+  if get_kernel(sigma, truncate)[1] >= PARAMS["fft-min-radius"] and np.ndim(img) == 2:
+    return fft_gaussian_filter1d(img, sigma, axis, truncate)
+  return ndimage.gaussian_filter1d(img, sigma, axis=axis, truncate=truncate)
+
+def get_blur_error(img, sigma, axis):
+  '''
+  The largest difference between fft_gaussian_filter1d and
+  scipy.ndimage.gaussian_filter1d on **img**.
+  '''
+  direct = ndimage.gaussian_filter1d(img, sigma, axis=axis)
+  return float(np.amax(np.abs(fft_gaussian_filter1d(img, sigma, axis) - direct)))
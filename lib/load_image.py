@@ -1,6 +1,9 @@
-from skimage import io, img_as_float
+from skimage import io, img_as_float, img_as_float32
+from .precision import Precision
 
 def image_as_float(img):
+  if Precision.compact:
+    return img_as_float32(img)
   return img_as_float(img)
 
 def get_grayscale_image(filename):
@@ -2,7 +2,7 @@ from .timer import timeStart, timeEnd
 from .debug import Debug
 from .stats_recorder import Record
 
-from .otsu_threshold_image import otsu_threshold_image
+from .quantized_image import QuantizedImage
 from .hough_lines import get_all_hough_lines
 from .quality_control import points_to_rho_theta
 from skimage.morphology import remove_small_objects
@@ -42,7 +42,12 @@ def detect_meanlines(masked_image, corners, scale=1):
   Debug.save_image("meanlines", "bounded_image", bounded_image.filled(0))
 
   timeStart("threshold image")
-  black_and_white_image = otsu_threshold_image(bounded_image)
+  # the histogram of the bounded image is that of a region of the
+  # masked image, whose gray levels are quantized once per run and
+  # shared with the flatten stage and the roi stats
+  region = (slice(top_bound, bottom_bound), slice(left_bound, right_bound))
+  threshold_value = QuantizedImage.of(masked_image).get_otsu_threshold(region)
+  black_and_white_image = bounded_image > threshold_value
   timeEnd("threshold image")
 
   Debug.save_image("meanlines", "thresholded_image", black_and_white_image)
@@ -7,6 +7,7 @@ Created on Sun Nov  9 21:53:26 2014
 
 import numpy as np
 from math import sqrt
+from scipy.spatial import cKDTree
 from lib.debug import Debug
 
 generator = Debug.random
@@ -32,13 +33,8 @@ def best_candidate_sample(coords, num_samples, num_candidates = 10):
     The coordinates of the chosen sample points. The array has two columns
     and num_samples rows.
   '''
-  samples = [get_candidates(coords,num_candidates)[0]]
-  for i in range(1,num_samples):
-    candidates = get_candidates(coords, num_candidates)
-    best_candidate = find_best_candidate(candidates, samples)
-    samples.append(best_candidate)
-  samples = np.asarray(samples)
-  return samples
+  return choose_best_candidates(lambda: get_candidates(coords, num_candidates),
+                                num_samples)
 
 def get_candidates(coords, num_candidates):
   random_indices = generator.choice(len(coords), num_candidates)
@@ -66,13 +62,8 @@ def best_candidate_sample_from_rect(shape, num_samples, num_candidates = 10):
     The coordinates of the chosen sample points. The array has two columns
     and num_samples rows.
   '''
-  samples = [get_candidates_from_rect(shape,num_candidates)[0]]
-  for i in range(1,num_samples):
-    candidates = get_candidates_from_rect(shape, num_candidates)
-    best_candidate = find_best_candidate(candidates, samples)
-    samples.append(best_candidate)
-  samples = np.asarray(samples)
-  return samples
+  return choose_best_candidates(lambda: get_candidates_from_rect(shape, num_candidates),
+                                num_samples)
 
 def get_candidates_from_rect(shape, num_candidates):
   candidates = np.zeros((num_candidates,2),dtype=int)
@@ -80,25 +71,89 @@ def get_candidates_from_rect(shape, num_candidates):
   candidates[:,1] = generator.randint(0,high=shape[1],size=num_candidates)
   return candidates
 
+def best_candidate_sample_from_mask(mask, num_samples, num_candidates = 10):
+  '''
+  Sample points randomly from the unmasked pixels of a 2-D array using
+  Mitchell's Best Candidate sampling algorithm. Candidates are drawn from
+  the bounding rectangle of the unmasked pixels, and masked candidates are
+  rejected, so the coordinates of the unmasked pixels are never listed.
+
+  Parameters
+  ------------
+  mask : 2-D numpy array of bools
+    True where pixels must not be sampled.
+  num_samples : int
+    The number of samples to take.
+  num_candidates : int, optional
+    The number of candidate samples to consider per sample point.
+
+  Returns
+  ---------
+  samples : 2-D numpy array of ints
+    The coordinates of the chosen sample points. The array has two columns
+    and num_samples rows.
+  '''
+  rows = np.flatnonzero(~mask.all(axis=1))
+  cols = np.flatnonzero(~mask.all(axis=0))
+  if len(rows) == 0:
+    raise ValueError("Every pixel is masked")
+  bounds = ((rows[0], rows[-1] + 1), (cols[0], cols[-1] + 1))
+
+  return choose_best_candidates(lambda: get_candidates_from_mask(mask, bounds, num_candidates),
+                                num_samples)
+
+def get_candidates_from_mask(mask, bounds, num_candidates):
+  candidates = np.zeros((0,2),dtype=int)
+  while len(candidates) < num_candidates:
+    drawn = np.zeros((num_candidates,2),dtype=int)
+    drawn[:,0] = generator.randint(bounds[0][0],high=bounds[0][1],size=num_candidates)
+    drawn[:,1] = generator.randint(bounds[1][0],high=bounds[1][1],size=num_candidates)
+    drawn = drawn[~mask[drawn[:,0],drawn[:,1]]]
+    candidates = np.concatenate((candidates, drawn))
+  return candidates[:num_candidates]
+
+def choose_best_candidates(draw_candidates, num_samples, rebuild_interval = 64):
+  '''
+  Mitchell's Best Candidate algorithm: each new sample is the candidate
+  returned by **draw_candidates** that is furthest from the samples
+  chosen so far.
+
+  Samples are kept in a KD-tree, which is rebuilt every
+  **rebuild_interval** samples; the samples added since the last rebuild
+  are checked directly. Both searches are exact, so the samples are the
+  same as those of a brute force search.
+  '''
+  samples = np.zeros((num_samples, 2), dtype=int)
+  samples[0] = draw_candidates()[0]
+  tree = None
+  num_in_tree = 0
+  for i in range(1,num_samples):
+    if i - num_in_tree >= rebuild_interval:
+      tree = cKDTree(samples[:i])
+      num_in_tree = i
+
+    candidates = draw_candidates()
+    closest_d = find_closest_distances(candidates, samples[num_in_tree:i])
+    if tree is not None:
+      closest_d = np.minimum(closest_d, tree.query(candidates)[0])
+    # the first of the candidates furthest from their closest sample
+    samples[i] = candidates[np.argmax(closest_d)]
+  return samples
+
+def find_closest_distances(candidates, samples):
+  # distances from every candidate to every sample, in one go
+  differences = candidates[:,np.newaxis,:] - samples[np.newaxis,:,:]
+  return np.sqrt((differences**2).sum(axis=2)).min(axis=1, initial=np.inf)
+
 def find_best_candidate(candidates, samples):
-  best_candidate = None
-  furthest_d = 0
-  for candidate in candidates:
-    _,dist = find_closest(candidate, samples)
-    if dist > furthest_d:
-      best_candidate = candidate
-      furthest_d = dist
-  return best_candidate
+  closest_d = find_closest_distances(candidates, np.asarray(samples))
+  return candidates[np.argmax(closest_d)]
 
 def find_closest(point, points):
-  closest_p = points[0]
-  closest_d = distance(point, closest_p)
-  for p in points:
-    d = distance(point, p)
-    if d < closest_d:
-      closest_p = p
-      closest_d = d
-  return [closest_p, closest_d]
+  points = np.asarray(points)
+  distances = np.sqrt(((points - point)**2).sum(axis=1))
+  closest = np.argmin(distances)
+  return [points[closest], distances[closest]]
 
 def distance(p1, p2):
   return sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
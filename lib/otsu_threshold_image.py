@@ -1,10 +1,7 @@
-from skimage.filters import threshold_otsu
-from numpy.ma.core import MaskedArray
+from .quantized_image import QuantizedImage
 
 def otsu_threshold_image(grayscale_image):
-  if (type(grayscale_image) is MaskedArray):
-    threshold_value = threshold_otsu(grayscale_image.compressed())
-  else:
-    threshold_value = threshold_otsu(grayscale_image)
+  # masked pixels are left out of the histogram
+  threshold_value = QuantizedImage.of(grayscale_image).get_otsu_threshold()
   black_and_white_image = (grayscale_image > threshold_value)
   return black_and_white_image
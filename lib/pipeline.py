@@ -0,0 +1,163 @@
+from lib.timer import timeStart, timeEnd, Tracer
+from lib.stage_cache import StageCache
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage:
+  '''
+  A named step of the pipeline.
+
+  Attributes
+  -------------
+  name : string
+  function : function
+    Called with the values named in inputs, in order. Should return
+    None if the stage has no outputs, a single value if it has one
+    output, or a tuple of values in the order given by outputs.
+  inputs : list of strings
+    Names of the values the stage consumes.
+  outputs : list of strings
+    Names of the values the stage produces.
+  cached : bool
+    If True, the outputs (which must be numpy arrays) are saved to and
+    loaded from the StageCache under the stage's name. A stage whose
+    outputs are already cached doesn't need its inputs at all.
+  '''
+  def __init__(self, name, function, inputs=[], outputs=[], cached=False):
+    self.name = name
+    self.function = function
+    self.inputs = inputs
+    self.outputs = outputs
+    self.cached = cached
+
+  def is_cached(self):
+    return self.cached and StageCache.has(self.name)
+
+  def run(self, inputs):
+    if self.cached:
+      def compute():
+        return self.outputs_to_dict(self.function(*inputs))
+      result = StageCache.fetch(self.name, compute)
+      return { name: result[name] for name in self.outputs }
+    else:
+      return self.outputs_to_dict(self.function(*inputs))
+
+  def outputs_to_dict(self, result):
+    if len(self.outputs) == 0:
+      return {}
+    elif len(self.outputs) == 1:
+      return { self.outputs[0]: result }
+    else:
+      return dict(zip(self.outputs, result))
+
+class Pipeline:
+  '''
+  A small dependency graph of stages. Stages whose inputs are available
+  run concurrently on a thread pool. This helps because most of the heavy
+  lifting happens in numpy, scipy, and skimage routines that release
+  the GIL.
+  '''
+  def __init__(self, stages):
+    self.stages = stages
+    self.producers = {}
+    for stage in stages:
+      for output in stage.outputs:
+        self.producers[output] = stage
+
+  def get_required_stages(self, values, targets):
+    '''
+    Returns the stages that must run to produce **targets** (names of
+    values or of stages), given the values that are already available.
+    Stages with cached outputs don't pull in their inputs.
+    '''
+    required = []
+    stack = list(targets)
+    seen = set()
+    while len(stack) > 0:
+      target = stack.pop()
+      if (target in seen) or (target in values):
+        continue
+      seen.add(target)
+
+      stage = self.producers.get(target)
+      if stage is None:
+        stage = next((s for s in self.stages if s.name == target), None)
+      if stage is None:
+        raise ValueError("No stage produces %s" % target)
+
+      if stage in required:
+        continue
+      required.append(stage)
+
+      if not stage.is_cached():
+        stack.extend(stage.inputs)
+
+    # keep the order in which stages were declared
+    return [ stage for stage in self.stages if stage in required ]
+
+  def run(self, values, targets, num_threads=4):
+    '''
+    Runs every stage needed to produce **targets**, starting from
+    the initial **values** (a dict). Intermediate values are dropped as
+    soon as their last consumer has run.
+
+    Returns
+    --------
+    values : dict
+      The initial values plus the values named in targets.
+    '''
+    values = dict(values)
+    stages = self.get_required_stages(values, targets)
+
+    # stages that will be loaded from the cache don't consume their inputs.
+    # Decide this once, up front, since running a stage caches its outputs.
+    from_cache = [ stage for stage in stages if stage.is_cached() ]
+
+    def get_inputs(stage):
+      return [] if stage in from_cache else stage.inputs
+
+    # count the consumers of each value, so we know when to free it
+    consumers = {}
+    for stage in stages:
+      for name in get_inputs(stage):
+        consumers[name] = consumers.get(name, 0) + 1
+
+    # spans of the stages, which run on the pool's threads,
+    # nest under the span that is open here
+    parent_span = Tracer.get_current()
+
+    pending = list(stages)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+
+    try:
+      while pending or running:
+        for stage in list(pending):
+          if all(name in values for name in get_inputs(stage)):
+            pending.remove(stage)
+            inputs = [ values[name] for name in get_inputs(stage) ]
+            running[executor.submit(self.run_stage, stage, inputs, parent_span)] = stage
+
+        if len(running) == 0:
+          raise ValueError("Stages %s can never run" % [ stage.name for stage in pending ])
+
+        done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+        for future in done:
+          stage = running.pop(future)
+          values.update(future.result())
+
+          for name in get_inputs(stage):
+            consumers[name] -= 1
+            if consumers[name] == 0 and name not in targets:
+              del values[name]
+    finally:
+      executor.shutdown(wait=True)
+
+    return values
+
+  def run_stage(self, stage, inputs, parent_span=None):
+    Tracer.set_root(parent_span)
+    timeStart("stage %s" % stage.name)
+    outputs = stage.run(inputs)
+    timeEnd("stage %s" % stage.name)
+    return outputs
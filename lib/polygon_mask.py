@@ -10,7 +10,7 @@ def get_polygon_coordinates(polygon_feature):
 def mask_image(image, polygon_feature):
   (y, x) = get_polygon_coordinates(np.array(polygon_feature))
   rr, cc = polygon(y, x)
-  mask = np.ones(image.shape)
+  mask = np.ones(image.shape, dtype=bool)
   coords_in_mask = (rr >= 0) & (rr < image.shape[0]) & (cc >= 0) & (cc < image.shape[1])
   mask[rr[coords_in_mask], cc[coords_in_mask]] = 0
   return ma.masked_array(image, mask=mask)
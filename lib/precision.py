@@ -0,0 +1,23 @@
+import numpy as np
+
+class Precision:
+  '''
+  The floating point dtype used for images and threshold surfaces
+  throughout the pipeline.
+
+  By default this is float64. In compact mode it's float32, which roughly
+  halves the memory needed for a full-size seismogram. (Label images and
+  watershed markers are always int32 and uint8, respectively.)
+  '''
+
+  compact = False
+  float_dtype = np.float64
+
+  @classmethod
+  def set_compact(cls, compact):
+    cls.compact = compact
+    cls.float_dtype = np.float32 if compact else np.float64
+
+  @classmethod
+  def as_float(cls, img):
+    return img.astype(cls.float_dtype, copy=False)
@@ -0,0 +1,78 @@
+from lib.timer import timeStart, timeEnd
+from lib.stats_recorder import Record
+
+import traceback
+from skimage.transform import downscale_local_mean
+
+from .roi_detection import get_roi, corners_to_geojson
+from .polygon_mask import mask_image
+from .meanline_detection import detect_meanlines
+from .quality_control import get_roi_area_error, get_roi_angle_errors, \
+                             check_roi, check_roi_angles, check_meanlines
+
+PARAMS = {
+  # the roi and meanlines are still found reliably at 1/16 of full size
+  "preview-scale": 0.0625
+}
+
+def get_preview_scores(image, scale):
+  preview_scale = min(scale, PARAMS["preview-scale"])
+  factor = max(1, int(round(scale / preview_scale)))
+  preview_scale = scale / factor
+
+  timeStart("downsample image by %s" % factor)
+  small_image = downscale_local_mean(image, (factor, factor))
+  timeEnd("downsample image by %s" % factor)
+
+  timeStart("get region of interest")
+  corners = get_roi(small_image, scale=preview_scale)
+  timeEnd("get region of interest")
+
+  timeStart("detect meanlines")
+  roi_polygon = corners_to_geojson(corners)["geometry"]["coordinates"][0]
+  masked_image = mask_image(small_image, roi_polygon)
+  lines = detect_meanlines(masked_image, corners, scale=preview_scale)
+  timeEnd("detect meanlines")
+
+  rotation, skew = get_roi_angle_errors(corners)
+  scores = {
+    "roi_area_error": float("%.4f" % get_roi_area_error(corners, preview_scale)),
+    "roi_rotation": float("%.4f" % rotation),
+    "roi_skew": float("%.4f" % skew),
+    "num_meanlines": len(lines)
+  }
+  passed = check_roi(corners, preview_scale) and check_roi_angles(corners) and \
+           check_meanlines(lines)
+  return (passed, scores)
+
+def preview_scan(image, scale=1):
+  '''
+  Finds the roi and meanlines of a downsampled copy of **image**, and
+  checks that they look like those of a good scan (see quality_control).
+  This takes a fraction of a second, so bad scans can be rejected before
+  the expensive stages run.
+
+  The scores are recorded as preview_* stats.
+
+  Returns
+  --------
+  passed : bool
+  '''
+  # the roi and meanline stages record their own stats, which mustn't be
+  # mistaken for those of the full-size image
+  stats = dict(Record.stats)
+
+  try:
+    passed, scores = get_preview_scores(image, scale)
+  except Exception:
+    # a scan too broken to preview is too broken to analyze
+    traceback.print_exc()
+    passed, scores = False, {}
+
+  Record.stats = stats
+  for key, value in scores.items():
+    Record.record("preview_" + key, value)
+  Record.record("preview_passed", bool(passed))
+
+  print("preview scores: %s" % scores)
+  return passed
@@ -1,18 +1,66 @@
 import numpy as np
 from lib.utilities import poly_area2D
 
-def check_roi(corners):
-  target_area = 65352425
-  acceptable_error = 0.05
+PARAMS = {
+  # area of the roi of a full-size seismogram
+  "target-roi-area": 65352425,
+  "acceptable-area-error": 0.05,
+  # radians
+  "max-roi-rotation": 0.087,
+  "max-roi-skew": 0.035,
+  "min-meanlines": 15,
+  "max-meanlines": 32
+}
+
+def get_roi_area_error(corners, scale=1):
+  target_area = PARAMS["target-roi-area"] * scale * scale
 
   corners_clockwise = [
     corners["top_left"], corners["top_right"],
     corners["bottom_right"], corners["bottom_left"]
   ]
   roi_area = poly_area2D(corners_clockwise)
-  error = abs(roi_area - target_area) / target_area
+  return abs(roi_area - target_area) / target_area
+
+def check_roi(corners, scale=1):
+  return (get_roi_area_error(corners, scale) <= PARAMS["acceptable-area-error"])
+
+def angle_difference(theta0, theta1):
+  # lines have no direction, so angles are only defined modulo pi
+  difference = (theta0 - theta1) % np.pi
+  return min(difference, np.pi - difference)
+
+def get_roi_angle_errors(corners):
+  '''
+  Returns
+  --------
+  rotation : float
+    How far the top of the roi is from horizontal, in radians.
+  skew : float
+    How far the roi is from a rectangle: the largest deviation, in
+    radians, of opposite sides from parallel or of adjacent sides
+    from perpendicular.
+  '''
+  _, top = points_to_rho_theta(corners["top_left"], corners["top_right"])
+  _, bottom = points_to_rho_theta(corners["bottom_right"], corners["bottom_left"])
+  _, left = points_to_rho_theta(corners["top_left"], corners["bottom_left"])
+  _, right = points_to_rho_theta(corners["bottom_right"], corners["top_right"])
+
+  rotation = angle_difference(top, -np.pi/2)
+  skew = max(
+    angle_difference(top, bottom),
+    angle_difference(left, right),
+    abs(angle_difference(top, left) - np.pi/2),
+    abs(angle_difference(bottom, right) - np.pi/2)
+  )
+  return (rotation, skew)
+
+def check_roi_angles(corners):
+  rotation, skew = get_roi_angle_errors(corners)
+  return (rotation <= PARAMS["max-roi-rotation"]) and (skew <= PARAMS["max-roi-skew"])
 
-  return (error <= acceptable_error)
+def check_meanlines(lines):
+  return PARAMS["min-meanlines"] <= len(lines) <= PARAMS["max-meanlines"]
 
 # transform coordinates describing a line
 # from two (x, y) pairs to one (rho, theta) pair
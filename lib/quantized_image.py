@@ -0,0 +1,168 @@
+'''
+Grayscale images as 256 gray levels, with cached histograms.
+
+Several stages need a histogram of the same image: the roi and meanline
+stages threshold it with Otsu's method, the mask stage records its
+intensity histogram, and the threshold functions work on the
+histograms of its blocks. Each image is quantized to uint8 once per run
+(see QuantizedImage.of), and each histogram is counted once, so Otsu's
+method and the background statistics cost O(256) operations instead of
+passes over the whole image.
+
+'''
+
+import threading
+import weakref
+
+import numpy as np
+import numpy.ma as ma
+
+def quantize(img):
+  '''
+  Quantizes a grayscale image to 256 levels, the same way the threshold
+  functions bin pixel values.
+
+  Parameters
+  ------------
+  img : 2-D numpy array or masked array
+    Either floats on the interval [0,1] or ints on the interval [0,255].
+
+  Returns
+  --------
+  levels : 2-D numpy array of uint8
+  mask : 2-D numpy array of bools, or None
+    The pixels to leave out of histograms.
+  bin_edges : 1-D numpy array
+    The 257 edges of the histogram bins, in the units of **img**.
+  '''
+  mask = ma.getmaskarray(img) if (type(img) is ma.MaskedArray) else None
+  data = ma.getdata(img)
+
+  if np.amax(img) <= 1:
+    levels = np.round(255 * data)
+    bin_edges = np.linspace(0, 256/255, num = 257)
+  else:
+    levels = data
+    bin_edges = np.arange(257)
+
+  levels = np.clip(levels, 0, 255).astype(np.uint8)
+  return (levels, mask, bin_edges)
+
+def get_otsu_index(hist, bin_centers):
+  '''
+  Otsu's method on a histogram, computed as skimage's threshold_otsu does
+  once it has binned the image.
+
+  Returns
+  --------
+  index : int
+    The last bin below the threshold.
+  '''
+  # like threshold_otsu, only look between the lowest and highest values
+  nonzero = np.flatnonzero(hist)
+  if len(nonzero) < 2:
+    return nonzero[0] if len(nonzero) else 0
+  first, last = nonzero[0], nonzero[-1] + 1
+  hist = hist[first:last].astype(float)
+  bin_centers = bin_centers[first:last]
+
+  weight1 = np.cumsum(hist)
+  weight2 = np.cumsum(hist[::-1])[::-1]
+  mean1 = np.cumsum(hist * bin_centers) / weight1
+  mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+  variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+  return first + int(np.argmax(variance12))
+
+def get_otsu_threshold(img):
+  '''
+  Equivalent to skimage's threshold_otsu, for any array (e.g. of slopes,
+  which aren't gray levels), from one histogram of **img**.
+  '''
+  low, high = np.amin(img), np.amax(img)
+  if low == high:
+    return low
+  hist, bin_edges = np.histogram(img, bins=256, range=(low, high))
+  bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+  return bin_centers[get_otsu_index(hist, bin_centers)]
+
+class QuantizedImage:
+  '''
+  The gray levels of an image and the 256-bin histograms of its regions,
+  counted once each.
+
+  Attributes
+  -------------
+  shape : tuple
+  levels : 2-D numpy array of uint8
+    The quantized image (see quantize).
+  mask : 2-D numpy array of bools, or None
+    Pixels left out of histograms.
+  bin_edges : 1-D numpy array
+  gray_level : float
+    The difference between adjacent levels, in the units of the image.
+  '''
+  # id of an image -> (weak reference to the image, its QuantizedImage)
+  cache = {}
+  # reentrant, since an image can be collected (and forgotten) while
+  # the lock is held
+  lock = threading.RLock()
+
+  @classmethod
+  def of(cls, img):
+    '''
+    Returns the QuantizedImage of **img**, quantizing it only the first
+    time it's asked for during this run. **img** must not be modified
+    in place afterwards.
+    '''
+    if isinstance(img, QuantizedImage):
+      return img
+
+    with cls.lock:
+      ref, quantized = cls.cache.get(id(img), (None, None))
+      if ref is None or ref() is not img:
+        quantized = cls(img)
+        cls.cache[id(img)] = (weakref.ref(img, cls.forget(id(img))), quantized)
+      return quantized
+
+  @classmethod
+  def reset(cls):
+    with cls.lock:
+      cls.cache = {}
+
+  @classmethod
+  def forget(cls, image_id):
+    def callback(ref):
+      with cls.lock:
+        if cls.cache.get(image_id, (None,))[0] is ref:
+          del cls.cache[image_id]
+    return callback
+
+  def __init__(self, img):
+    self.shape = img.shape
+    self.levels, self.mask, self.bin_edges = quantize(img)
+    self.gray_level = self.bin_edges[1] - self.bin_edges[0]
+    self.histograms = {}
+
+  def get_histogram(self, region = None):
+    '''
+    Returns the 256-bin histogram of the unmasked pixels in **region**, a
+    (row slice, column slice) tuple, or in the whole image if it's None.
+    '''
+    key = None if region is None else \
+          tuple(s.indices(n) for s, n in zip(region, self.shape))
+
+    if key not in self.histograms:
+      levels = self.levels if region is None else self.levels[region]
+      if self.mask is not None:
+        levels = levels[~(self.mask if region is None else self.mask[region])]
+      self.histograms[key] = np.bincount(levels.ravel(), minlength=256)
+    return self.histograms[key]
+
+  def get_otsu_threshold(self, region = None):
+    '''
+    Otsu's threshold of the unmasked pixels in **region** (see
+    get_histogram), in the units of the image. It lies halfway between two
+    gray levels, so comparing the image with it is unaffected by rounding.
+    '''
+    index = get_otsu_index(self.get_histogram(region), np.arange(256))
+    return (index + 0.5) * self.gray_level
@@ -12,150 +12,342 @@ Created on Wed Feb 11 18:20:36 2015
 @author: benamy
 """
 
-from lib.timer import timeStart, timeEnd
+from lib.timer import timeStart, timeEnd, Tracer
 from lib.debug import Debug, pad
+from lib.precision import Precision
+from lib.stats_recorder import Record
 
 import numpy as np
 from math import log
-from scipy import ndimage
-from scipy.ndimage.filters import gaussian_filter1d, gaussian_laplace
-from skimage.feature import peak_local_max
-from skimage.filters import threshold_otsu
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import gaussian_laplace
 from skimage.morphology import remove_small_objects
 
-from lib.utilities import normalize
-
-def get_ridge_region_vert(ridges, shape):
+from lib.quantized_image import get_otsu_threshold
+from lib.gaussian_blur import gaussian_filter1d
+from lib.feature_bank import FeatureBank
+
+PARAMS = {
+  # the narrowest blur can't get much below a pixel
+  "min-sigma": lambda scale: 0.7071,
+  # about twice the width of a typical trace (see roi_detection), so
+  # the maxima of the thickest traces are found too
+  "max-sigma": lambda scale: 30*scale,
+  "sigma-ratio": 1.9,
+  "min-ridge-length": lambda scale: max(1, int(round(15*scale))),
+  # the number of scales is only capped if this is set
+  "max-scales": None
+}
+
+def get_ridge_region(ridges, shape, axis):
   '''
+  Paints the ridge region of **ridges** (as compile_ridge_data returns
+  them) along **axis** of an image of dimensions **shape**. Each ridge
+  paints its max_value on [position - width, position + width) along the
+  axis, where width is round(sqrt(2) * sigma), with both ends clipped to
+  [0, shape[axis] - 1]. Where spans overlap, the last ridge wins.
+
+  Instead of painting the spans one at a time, the ridges are grouped by
+  width and by the line they lie on. compile_ridge_data lists ridges in
+  row-major order, so within a group their spans are translates of each
+  other in order, and each ridge only shows until the next one starts.
+  Those visible runs are expanded into pixels all at once, and the last
+  ridge painting each pixel is found with a maximum over the groups.
   '''
-  ridge_region = np.zeros(shape, dtype=float)
-
-  for row, col, sigma, max_value in ridges:
-    ridge_width = round(np.sqrt(2) * sigma)
-    bounds = np.array([col-ridge_width, col+ridge_width])
-    bounds = np.clip(bounds, 0, shape[1]-1)
-    ridge_region[row, bounds[0]:bounds[1]] = max_value
+  ridges = np.asarray(ridges, dtype=float).reshape((-1, 4))
+  positions = ridges[:, axis].astype(np.intp)
+  lines = ridges[:, 1 - axis].astype(np.intp)
+  widths = np.round(np.sqrt(2) * ridges[:, 2]).astype(np.intp)
+  starts = np.clip(positions - widths, 0, shape[axis] - 1)
+  stops = np.clip(positions + widths, 0, shape[axis] - 1)
+
+  # a ridge's run ends where the next ridge of its group starts
+  order = np.lexsort((np.arange(len(ridges)), lines, widths))
+  starts, stops, lines = starts[order], stops[order], lines[order]
+  same_group = (widths[order][1:] == widths[order][:-1]) & (lines[1:] == lines[:-1])
+  stops[:-1][same_group] = np.minimum(stops[:-1][same_group], starts[1:][same_group])
+  lengths = np.maximum(stops - starts, 0)
+
+  # the pixels of every run
+  run_starts = np.cumsum(lengths) - lengths
+  painters = np.repeat(order, lengths)
+  run_positions = np.repeat(starts - run_starts, lengths) + np.arange(lengths.sum())
+  run_lines = np.repeat(lines, lengths)
+  coords = (run_positions, run_lines) if axis == 0 else (run_lines, run_positions)
+
+  painter = np.full(shape, -1, dtype=np.intp)
+  np.maximum.at(painter, coords, painters)
 
+  ridge_region = np.zeros(shape, dtype=float)
+  painted = painter >= 0
+  ridge_region[painted] = ridges[painter[painted], 3]
   return ridge_region
 
-def get_ridge_region_horiz(ridges, shape):
+def get_ridge_region_vert(ridges, shape):
   '''
+  The horizontal spans around vertical ridges (see get_ridge_region).
   '''
-  ridge_region = np.zeros(shape, dtype=float)
-
-  for row, col, sigma, max_value in ridges:
-    ridge_width = round(np.sqrt(2) * sigma)
-    bounds = np.array([row-ridge_width, row+ridge_width])
-    bounds = np.clip(bounds, 0, shape[0]-1)
-    ridge_region[bounds[0]:bounds[1], col] = max_value
-
-  return ridge_region
-
-def get_slopes(img, axis):
-  abs_sobel = np.abs(ndimage.sobel(img, axis=axis))
-  return abs_sobel > threshold_otsu(abs_sobel)
-
-def create_image_cube(img, sigma_list, axis):
-  gaussian_blurs = [gaussian_filter1d(img, s, axis=axis) for s in sigma_list]
-  num_scales = len(gaussian_blurs) - 1
-  image_cube = np.zeros((img.shape[0], img.shape[1], num_scales))
-  for i in range(num_scales):
-    image_cube[:,:,i] = ((gaussian_blurs[i] - gaussian_blurs[i + 1]))
-    Debug.save_image("ridges", "image_cube-" + pad(i), image_cube[:,:,i])
-  return image_cube
-
-def create_exclusion_cube(img, image_cube, dark_pixels, convex_pixels,
-                          axis, convex_threshold):
-
-  timeStart("get slopes")
-  slopes = get_slopes(img, axis=axis)
-  timeEnd("get slopes")
+  return get_ridge_region(ridges, shape, axis=1)
 
-  Debug.save_image("ridges", "slopes", slopes)
-
-  exclusion_cube = np.zeros(image_cube.shape, dtype=bool)
-  exclusion_cube[:,:,0] = dark_pixels | convex_pixels | slopes \
-                        | (image_cube[:,:,0] < -convex_threshold)
-
-  Debug.save_image("ridges", "exclusion_cube_base", exclusion_cube[:,:,0])
+def get_ridge_region_horiz(ridges, shape):
+  '''
+  The vertical spans around horizontal ridges (see get_ridge_region).
+  '''
+  return get_ridge_region(ridges, shape, axis=0)
 
-  num_scales = image_cube.shape[2]
-  for i in range(1, num_scales):
-    # each layer of the exclusion cube contains the previous layer
-    # plus all convex pixels in the current image_cube layer
-    exclusion_cube[:,:,i] = (exclusion_cube[:,:,i-1] \
-                            | (image_cube[:,:,i] < -convex_threshold))
-    Debug.save_image("ridges", "exclusion_cube-" + pad(i), exclusion_cube[:,:,i])
+def get_slopes(img, axis, threshold=None):
+  abs_sobel = np.abs(FeatureBank.get("sobel-axis", img, axis=axis))
+  if threshold is None:
+    threshold = get_otsu_threshold(abs_sobel)
+  return abs_sobel > threshold
 
-  return exclusion_cube
+def get_slope_threshold(img, axis):
+  abs_sobel = np.abs(FeatureBank.get("sobel-axis", img, axis=axis))
+  return get_otsu_threshold(abs_sobel)
 
-def find_valid_maxima(image_cube, footprint, exclusion, low_threshold):
+def get_dog_layers(img, sigma_list, axis):
+  '''
+  Yields the layers of the difference of gaussians image cube one at a
+  time, so that no more than two blurs are ever held at once.
+  '''
+  previous_blur = gaussian_filter1d(img, sigma_list[0], axis=axis)
+  for i in range(len(sigma_list) - 1):
+    blur = gaussian_filter1d(img, sigma_list[i + 1], axis=axis)
+    layer = Precision.as_float(previous_blur - blur)
+    Debug.save_image("ridges", "image_cube-" + pad(i), layer)
+    previous_blur = blur
+    yield layer
+
+def get_normalized(values, low, high):
   '''
-  Returns a 3D array that is true everywhere that image_cube
-  has a local maxima except in regions marked for exclusion.
+  The values normalize() would give **values** in an array
+  whose minimum is **low** and whose maximum is **high**.
+  '''
+  return (values - low) / (high - low)
 
+def get_layer_maxima(below, layer, above, axis):
+  '''
+  Returns the maximum of the neighborhood of every pixel of **layer**:
+  the pixel and its two neighbors along **axis**, in **layer** and in the
+  layers of the image cube below and above it. That's a (3,1,3) or
+  (1,3,3) footprint, like in peak_local_max, and pixels at the ends of
+  the lines are their own missing neighbors, like maximum_filter's
+  "nearest" mode. Maxima are exact, so two shifted comparisons give the
+  same values as maximum_filter without stacking the layers.
   '''
+  scale_max = np.maximum(below, layer)
+  np.maximum(scale_max, above, out=scale_max)
 
-  # peak_local_max expects a normalized image (values between 0 and 1)
-  normalized_image_cube = normalize(image_cube)
+  neighborhood_max = scale_max.copy()
+  lines = np.moveaxis(scale_max, axis, 0)
+  maxima = np.moveaxis(neighborhood_max, axis, 0)
+  np.maximum(maxima[1:], lines[:-1], out=maxima[1:])
+  np.maximum(maxima[:-1], lines[1:], out=maxima[:-1])
+  return neighborhood_max
 
-  coordinates = peak_local_max(normalized_image_cube, min_distance=1,
-                          threshold_rel=0, threshold_abs=0, exclude_border=True,
-                          footprint=footprint)
-  maxima = np.zeros_like(normalized_image_cube, dtype=bool)
-  if coordinates.size > 0:
-      maxima[tuple(coordinates.T)] = True
-  return maxima & (~exclusion) & (image_cube >= low_threshold)
+class RidgeAccumulator:
+  '''
+  Collapses the valid maxima of the layers of an image cube, one layer at
+  a time, into the ridges, max_values and max_scales that
+  extract_ridge_data returns.
+
+  The maxima are the pixels that peak_local_max (with exclude_border,
+  which extract_ridge_data applies through the exclusion cube) would
+  find in the normalized image cube. Normalizing is monotonic, so
+  those are the pixels equal to the maximum of their neighborhood,
+  except that normalizing can round a pixel and a slightly bigger
+  neighbor to the same value. The normalization isn't known until every
+  layer has been seen, so such near ties are set aside and settled at the
+  end (see finish).
+  '''
+  def __init__(self, shape, low_threshold, tolerance):
+    self.low_threshold = low_threshold
+    self.tolerance = tolerance
+    self.ridges = np.zeros(shape, dtype=bool)
+    self.max_values = np.zeros(shape, dtype=Precision.float_dtype)
+    self.max_scales = np.zeros(shape, dtype=np.intp)
+    self.near_ties = []
+    self.low = None
+    self.high = None
+
+  def add_extremes(self, layer):
+    low, high = np.amin(layer), np.amax(layer)
+    self.low = low if self.low is None else min(self.low, low)
+    self.high = high if self.high is None else max(self.high, high)
+
+  def add_maxima(self, scale, layer, neighborhood_max, first_excluded):
+    valid = (layer >= self.low_threshold) & (scale < first_excluded)
+    maxima = valid & (layer == neighborhood_max)
+    self.update(scale, np.nonzero(maxima), layer[maxima])
+
+    near_ties = valid & (~maxima) & (neighborhood_max - layer <= self.tolerance)
+    if near_ties.any():
+      coords = np.nonzero(near_ties)
+      self.near_ties.append((scale, coords, layer[coords], neighborhood_max[coords]))
+
+  def update(self, scale, coords, values):
+    # the first scale at which a pixel reaches its largest value wins
+    old_values = self.max_values[coords]
+    better = (values > old_values) | ((values == old_values) & (scale < self.max_scales[coords]))
+    coords = tuple(c[better] for c in coords)
+    self.ridges[coords] = True
+    self.max_values[coords] = values[better]
+    self.max_scales[coords] = scale
+
+  def finish(self):
+    for scale, coords, values, neighborhood_max in self.near_ties:
+      ties = get_normalized(values, self.low, self.high) == \
+             get_normalized(neighborhood_max, self.low, self.high)
+      self.update(scale, tuple(c[ties] for c in coords), values[ties])
+    return self.ridges, self.max_values, self.max_scales
 
 def get_convex_pixels(img, convex_threshold):
   laplacian = gaussian_laplace(img, sigma=2)
   Debug.save_image("ridges", "gaussian_laplace", laplacian)
   return laplacian > convex_threshold
 
-def extract_ridge_data(img, sobel_axis, dog_axis, footprint, dark_pixels,
-                       convex_pixels, sigma_list, convex_threshold, low_threshold):
+def get_bands(length, num_bands):
+  '''
+  Splits range(length) into at most **num_bands** slices of nearly
+  equal lengths.
+  '''
+  edges = np.linspace(0, length, num_bands + 1).astype(int)
+  return [ slice(start, stop) for start, stop in zip(edges[:-1], edges[1:]) if stop > start ]
+
+def run_threads(function, tasks, num_threads):
+  '''
+  Returns [function(*task) for task in tasks], computed on a pool of
+  **num_threads** threads. The blurs and filters release the GIL, so the
+  tasks really do run in parallel. Spans timed by the tasks nest under
+  the span that is open here, and the stats they record go to the sinks
+  open here (see Record.collect).
   '''
+  if num_threads <= 1 or len(tasks) <= 1:
+    return [ function(*task) for task in tasks ]
+
+  parent_span = Tracer.get_current()
+  sinks = Record.get_sinks()
+  def run(task):
+    Tracer.set_root(parent_span)
+    Record.set_sinks(sinks)
+    return function(*task)
+
+  executor = ThreadPoolExecutor(max_workers=num_threads)
+  try:
+    return list(executor.map(run, tasks))
+  finally:
+    executor.shutdown(wait=True)
+
+def find_band_maxima(img, dog_axis, first_excluded, sigma_list,
+                     convex_threshold, low_threshold, tolerance):
+  '''
+  Finds the valid local maxima of the difference of gaussians image cube
+  of **img**. The cube is never built: its layers are made one at a time
+  and only the three that a maximum depends on are kept, so memory
+  doesn't grow with the number of scales.
+
+  **first_excluded** is the exclusion cube (see extract_ridge_data),
+  given with only the pixels excluded from every scale. It's filled in,
+  in place, as the layers are made.
+
+  Returns
+  -------
+  accumulator : RidgeAccumulator
+    Holds the maxima, and the extremes of the cube needed to finish it.
+  '''
+  accumulator = RidgeAccumulator(img.shape, low_threshold, tolerance)
+
+  # each layer of the exclusion cube contains the previous layer
+  # plus all convex pixels in the current image_cube layer
+  window = []
+  for i, layer in enumerate(get_dog_layers(img, sigma_list, axis=dog_axis)):
+    accumulator.add_extremes(layer)
+    first_excluded[(layer < -convex_threshold) & (first_excluded > i)] = i
+    if Debug.active:
+      Debug.save_image("ridges", "exclusion_cube_base" if i == 0 else "exclusion_cube-" + pad(i),
+                       first_excluded <= i)
+
+    window.append(layer)
+    if len(window) == 3:
+      # peak_local_max excludes the first and last scales like any border.
+      # Marking the pixels of layer i doesn't change which pixels of
+      # layer i - 1 are excluded.
+      below, middle, above = window
+      neighborhood_max = get_layer_maxima(below, middle, above, dog_axis)
+      accumulator.add_maxima(i - 1, middle, neighborhood_max, first_excluded)
+      window.pop(0)
+
+  return accumulator
+
+def extract_ridge_data(img, sobel_axis, dog_axis, dark_pixels,
+                       convex_pixels, sigma_list, convex_threshold, low_threshold,
+                       slope_threshold=None, num_bands=1):
+  '''
+  Finds the valid local maxima of the difference of gaussians image cube
+  of **img** (see find_band_maxima).
+
+  The blurs run along **dog_axis** and the maxima are compared along it
+  and across scales only, so bands of **img** across the other axis are
+  independent. If **num_bands** is more than 1, the image is cut into
+  that many bands, which are searched on as many threads. The result is
+  the same either way.
+
   Returns
   -------
   ridges : 2D boolean array
     True at every pixel considered to be a ridge.
   max_values : 2D float array
-    The maximum values across all sigma scales of image_cube.
+    The maximum values of the valid maxima across all sigma scales of
+    image_cube (0 where there are none).
   max_scales : 2D int array
     The scales at which the image_cube took on those maximum values.
 
   '''
   num_scales = len(sigma_list) - 1
 
-  timeStart("create difference of gaussian image cube at %s scales" % num_scales)
-  image_cube = create_image_cube(img, sigma_list, axis=dog_axis)
-  timeEnd("create difference of gaussian image cube at %s scales" % num_scales)
+  timeStart("get slopes")
+  slopes = get_slopes(img, axis=sobel_axis, threshold=slope_threshold)
+  timeEnd("get slopes")
 
-  timeStart("create exclusion cube")
-  exclusion = create_exclusion_cube(img,
-                                    image_cube=image_cube,
-                                    dark_pixels=dark_pixels,
-                                    convex_pixels=convex_pixels,
-                                    axis=sobel_axis,
-                                    convex_threshold=convex_threshold)
-  timeEnd("create exclusion cube")
-
-  timeStart("find image cube maxima")
-  maxima = find_valid_maxima(image_cube, footprint, exclusion, low_threshold)
-  timeEnd("find image cube maxima")
-
-  # set all non-maxima points in image_cube to 0
-  timeStart("suppress non-maxima")
-  image_cube[~maxima] = 0
-  timeEnd("suppress non-maxima")
-
-  timeStart("collapse cubes")
-  # ridges is a 2D array that is true everywhere
-  # that maxima has at least one true value in any scale
-  ridges = np.amax(maxima, axis=-1)
-  max_values = np.amax(image_cube, axis=-1)
-  max_scales = np.argmax(image_cube, axis=-1)
-  timeEnd("collapse cubes")
+  Debug.save_image("ridges", "slopes", slopes)
+
+  # Normalizing the image cube can only make a pixel tie with a neighbor
+  # if they're within a few rounding errors of each other. The difference
+  # of gaussians lies within +/- the range of the image.
+  value_range = 2 * float(np.amax(img) - np.amin(img))
+  tolerance = 8 * np.finfo(Precision.float_dtype).eps * value_range
+
+  # Each layer of the exclusion cube contains the one before it, so the
+  # cube is kept as the first scale at which each pixel is excluded
+  # (num_scales if it never is). Scale i of a pixel is excluded if
+  # i >= first_excluded.
+  exclusion = dark_pixels | convex_pixels | slopes
+  # like exclude_border in peak_local_max. Excluding the border up front
+  # keeps it out of the bands' borders.
+  exclusion[[0, -1], :] = True
+  exclusion[:, [0, -1]] = True
+  first_excluded = np.where(exclusion, 0, num_scales).astype(np.int8)
+
+  band_axis = 1 - dog_axis
+  bands = [ (slice(None), band) if band_axis == 1 else (band, slice(None))
+            for band in get_bands(img.shape[band_axis], num_bands) ]
+  tasks = [ (img[band], dog_axis, first_excluded[band], sigma_list,
+             convex_threshold, low_threshold, tolerance) for band in bands ]
+
+  timeStart("find maxima of difference of gaussians at %s scales" % num_scales)
+  accumulators = run_threads(find_band_maxima, tasks, num_bands)
+  timeEnd("find maxima of difference of gaussians at %s scales" % num_scales)
+
+  # the near ties are settled by normalizing the whole image cube
+  low = min(accumulator.low for accumulator in accumulators)
+  high = max(accumulator.high for accumulator in accumulators)
+
+  ridges = np.zeros(img.shape, dtype=bool)
+  max_values = np.zeros(img.shape, dtype=Precision.float_dtype)
+  max_scales = np.zeros(img.shape, dtype=np.intp)
+  for band, accumulator in zip(bands, accumulators):
+    accumulator.low, accumulator.high = low, high
+    ridges[band], max_values[band], max_scales[band] = accumulator.finish()
 
   return ridges, max_values, max_scales
 
@@ -168,27 +360,73 @@ def compile_ridge_data(sigmas_h, ridges_h, max_values_h):
 def create_sigma_list(min_sigma, sigma_ratio, scales):
   return min_sigma * np.power(sigma_ratio, scales)
 
-def find_ridges(img, dark_pixels, min_sigma = 0.7071, max_sigma = 30,
-            sigma_ratio = 1.9, min_ridge_length = 15,
-            low_threshold = 0.002, high_threshold = 0.006,
-            convex_threshold = 0.00015, figures=True):
-  '''
-  The values for min_sigma, max_sigma, and sigma_ratio are hardcoded,
-  but they ought to be a function of the scale parameter. They're related
-  to the minimum and maximum expected trace width in pixels.
-
-  If max_sigma is too small, the algorithm misses ridges of thick traces.
-  Need to do more thinking about how this function works.
-
-  '''
+def get_sigma_list(min_sigma, max_sigma, sigma_ratio, max_scales=None):
   # num_scales is the number of scales at which to compute a difference of gaussians
 
   # the following line in words: the number of times you need to multiply
   # min_sigma by sigma_ratio to get max_sigma
   num_scales = int(log(float(max_sigma) / min_sigma, sigma_ratio)) + 1
+  if max_scales is not None:
+    num_scales = min(num_scales, max_scales)
+
+  # maxima are only found at scales with a scale above and below them
+  num_scales = max(num_scales, 3)
 
   # a geometric progression of standard deviations for gaussian kernels
-  sigma_list = create_sigma_list(min_sigma, sigma_ratio, np.arange(num_scales + 1))
+  return create_sigma_list(min_sigma, sigma_ratio, np.arange(num_scales + 1))
+
+def get_ridge_params(scale=1, min_sigma=None, max_sigma=None, sigma_ratio=None,
+                     min_ridge_length=None, max_scales=None):
+  '''
+  The sigma ladder and minimum ridge length of find_ridges for a
+  seismogram of **scale**. Those that aren't given are taken from PARAMS.
+
+  Returns
+  --------
+  params : dict
+    min_sigma, max_sigma, sigma_ratio, min_ridge_length and max_scales.
+  '''
+  return {
+    "min_sigma": PARAMS["min-sigma"](scale) if min_sigma is None else min_sigma,
+    "max_sigma": PARAMS["max-sigma"](scale) if max_sigma is None else max_sigma,
+    "sigma_ratio": PARAMS["sigma-ratio"] if sigma_ratio is None else sigma_ratio,
+    "min_ridge_length": PARAMS["min-ridge-length"](scale) if min_ridge_length is None \
+                        else min_ridge_length,
+    "max_scales": PARAMS["max-scales"] if max_scales is None else max_scales
+  }
+
+def find_ridges(img, dark_pixels, scale = 1, min_sigma = None, max_sigma = None,
+            sigma_ratio = None, min_ridge_length = None, max_scales = None,
+            low_threshold = 0.002, high_threshold = 0.006,
+            convex_threshold = 0.00015, figures=True, slope_thresholds=None,
+            num_threads = 2, num_bands = 1):
+  '''
+  min_sigma, max_sigma, sigma_ratio and min_ridge_length default to
+  their values for **scale** (see get_ridge_params). They're related to
+  the minimum and maximum expected trace width in pixels. If max_sigma is
+  too small, the algorithm misses ridges of thick traces. **max_scales**,
+  if given, caps the number of scales, dropping the widest ones.
+
+  slope_thresholds, if given, is a (horizontal, vertical) pair of Otsu
+  thresholds for the Sobel slopes. By default they're computed from img,
+  but lib.tiling passes in thresholds computed from the whole image so
+  that every tile excludes the same slopes.
+
+  The horizontal and vertical ridges are found on **num_threads**
+  threads, and each of them is split into **num_bands** bands on as many
+  threads of its own (see extract_ridge_data). Each concurrent pass holds
+  its own blurs, so memory grows with the number of threads.
+
+  '''
+  params = get_ridge_params(scale, min_sigma, max_sigma, sigma_ratio,
+                            min_ridge_length, max_scales)
+  min_sigma, sigma_ratio = params["min_sigma"], params["sigma_ratio"]
+  min_ridge_length = params["min_ridge_length"]
+  sigma_list = get_sigma_list(min_sigma, params["max_sigma"], sigma_ratio,
+                              params["max_scales"])
+
+  if slope_thresholds is None:
+    slope_thresholds = (None, None)
 
   # convex_pixels is an image of regions with positive second derivative
   timeStart("get convex pixels")
@@ -197,23 +435,28 @@ def find_ridges(img, dark_pixels, min_sigma = 0.7071, max_sigma = 30,
   
   Debug.save_image("ridges", "convex_pixels", convex_pixels)
 
-  timeStart("find horizontal ridges")
-  footprint_h = np.ones((3,1,3), dtype=bool)
-  ridges_h, max_values_h, max_scales_h = \
-      extract_ridge_data(img, sobel_axis=1, dog_axis=0,
-                         footprint=footprint_h, dark_pixels=dark_pixels,
-                         convex_pixels=convex_pixels, sigma_list=sigma_list,
-                         convex_threshold=convex_threshold, low_threshold=low_threshold)
-  timeEnd("find horizontal ridges")
-
-  timeStart("find vertical ridges")
-  footprint_v = np.ones((1,3,3), dtype=bool)
-  ridges_v, max_values_v, max_scales_v = \
-      extract_ridge_data(img, sobel_axis=0, dog_axis=1,
-                         footprint=footprint_v, dark_pixels=dark_pixels,
-                         convex_pixels=convex_pixels, sigma_list=sigma_list,
-                         convex_threshold=convex_threshold, low_threshold=low_threshold)
-  timeEnd("find vertical ridges")
+  # the horizontal and vertical passes only share their inputs, so they
+  # run concurrently. Debug images are numbered in the order they're
+  # saved, so debug runs keep to one thread.
+  if Debug.active:
+    num_threads, num_bands = 1, 1
+
+  def find_ridges_along(name, sobel_axis, dog_axis, slope_threshold):
+    timeStart("find %s ridges" % name)
+    ridge_data = extract_ridge_data(img, sobel_axis=sobel_axis, dog_axis=dog_axis,
+                                    dark_pixels=dark_pixels,
+                                    convex_pixels=convex_pixels, sigma_list=sigma_list,
+                                    convex_threshold=convex_threshold,
+                                    low_threshold=low_threshold,
+                                    slope_threshold=slope_threshold, num_bands=num_bands)
+    timeEnd("find %s ridges" % name)
+    return ridge_data
+
+  (ridges_h, max_values_h, max_scales_h), (ridges_v, max_values_v, max_scales_v) = \
+      run_threads(find_ridges_along,
+                  [ ("horizontal", 1, 0, slope_thresholds[0]),
+                    ("vertical", 0, 1, slope_thresholds[1]) ],
+                  num_threads)
 
   # Horizontal ridges need to be prominent
   ridges_h = ridges_h & (max_values_h >= high_threshold)
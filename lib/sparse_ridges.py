@@ -0,0 +1,90 @@
+'''
+Ridge pixels as a sorted list, instead of a full-size boolean image.
+
+find_ridges(figures=False) lists the ridge pixels it finds, with the
+sigma and value of each maximum. Ridges cover a tiny fraction of a
+seismogram, so the pipeline keeps that list, wrapped in SparseRidges,
+between the ridge stage and the stages that consume it. Segmentation
+only looks at the ridge pixels themselves, grouped by segment, so its
+cost grows with the number of ridge pixels instead of with the area of
+the segments.
+
+'''
+
+import numpy as np
+
+class SparseRidges:
+  '''
+  The ridge pixels of an image, in row-major order.
+
+  Attributes
+  -------------
+  shape : tuple
+    The dimensions of the image.
+  indices : 1-D numpy array of ints
+    The sorted linear indices of the ridge pixels.
+  sigmas : 1-D numpy array
+    The sigma of the maximum at each ridge pixel.
+  max_values : 1-D numpy array
+    The value of the maximum at each ridge pixel.
+  '''
+  def __init__(self, ridge_data, shape):
+    '''
+    **ridge_data** is an array with a (row, column, sigma, max_value) row
+    for every ridge pixel, as find_ridges(figures=False) returns it.
+    '''
+    ridge_data = np.asarray(ridge_data).reshape((-1, 4))
+    self.shape = tuple(shape)
+    indices = np.ravel_multi_index((ridge_data[:, 0].astype(np.intp),
+                                    ridge_data[:, 1].astype(np.intp)), self.shape)
+    order = np.argsort(indices, kind="stable")
+    self.indices = indices[order]
+    self.sigmas = ridge_data[order, 2]
+    self.max_values = ridge_data[order, 3]
+
+  @classmethod
+  def from_image(cls, image):
+    '''
+    The ridge pixels of **image**, a 2-D boolean image of ridges like
+    find_ridges returns by default. It has no sigmas or max values, so
+    they're left at 0.
+    '''
+    coords = np.argwhere(image)
+    ridge_data = np.zeros((len(coords), 4))
+    ridge_data[:, :2] = coords
+    return cls(ridge_data, image.shape)
+
+  def __len__(self):
+    return len(self.indices)
+
+  def get_coords(self):
+    '''
+    Returns the (row, column) coordinates of the ridge pixels.
+    '''
+    return np.column_stack(np.unravel_index(self.indices, self.shape))
+
+  def to_image(self):
+    '''
+    Returns the ridges as a 2-D boolean image, like find_ridges does by
+    default.
+    '''
+    image = np.zeros(self.shape, dtype=bool)
+    image.flat[self.indices] = True
+    return image
+
+  def split_by_label(self, labels, num_labels):
+    '''
+    Groups the ridge pixels by their label in **labels**, an image of
+    ints.
+
+    Returns
+    --------
+    coords : list of 2-D numpy arrays
+      For each label from 1 to **num_labels**, the (row, column)
+      coordinates of the ridge pixels with that label, in row-major order.
+    '''
+    pixel_labels = labels.ravel()[self.indices]
+    order = np.argsort(pixel_labels, kind="stable")
+    bounds = np.searchsorted(pixel_labels[order], np.arange(1, num_labels + 2))
+    coords = self.get_coords()[order]
+    return [ coords[bounds[i]:bounds[i + 1]] for i in range(num_labels) ]
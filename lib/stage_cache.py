@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .dir import ensure_dir_exists
+from .stats_recorder import Record
+
+CORNER_NAMES = ["top_left", "top_right", "bottom_right", "bottom_left"]
+
+def hash_file(filename):
+  sha1 = hashlib.sha1()
+  with open(filename, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      sha1.update(chunk)
+  return sha1.hexdigest()
+
+class StageCache:
+  '''
+  An opt-in, on-disk cache of the outputs of individual pipeline stages.
+
+  Every stage output is keyed by a hash of the input image bytes, the
+  parameters of the stage and of every stage upstream of it, and a
+  per-stage version tag. Changing any of these gives a new key, so stale
+  outputs are never reused. Bump a stage's version whenever a code change
+  alters what that stage outputs.
+
+  Statistics recorded (with Record) while a stage is computed are cached
+  alongside its outputs and replayed when the outputs are loaded. Stages
+  only record stats when Record is active, so an entry stored by a run
+  without stats is a miss for a run with them, which stores it again.
+  '''
+
+  cache_dir = None
+  active = False
+  keys = {}
+
+  versions = {
+    "roi": 3,
+    "meanlines": 1,
+    "flatten": 6,
+    "ridges": 3,
+    "binary": 1,
+    "skeleton": 1
+  }
+
+  @classmethod
+  def set_directory(cls, cache_dir):
+    cls.cache_dir = cache_dir
+
+    if cache_dir is None:
+      cls.active = False
+    else:
+      ensure_dir_exists(cache_dir)
+      cls.active = True
+
+  @classmethod
+  def set_image(cls, filename):
+    '''
+    Start keying stages off the contents of a new input image.
+    '''
+    cls.keys = { "image": hash_file(filename) if cls.active else None }
+
+  @classmethod
+  def register(cls, stage, params, parent="image"):
+    '''
+    Compute the key of **stage** from its parameters and the key of the
+    stage whose outputs it consumes.
+    '''
+    description = json.dumps({
+      "stage": stage,
+      "version": cls.versions[stage],
+      "params": params,
+      "parent": cls.keys[parent]
+    }, sort_keys=True)
+    cls.keys[stage] = hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+  @classmethod
+  def get_path(cls, stage):
+    return os.path.join(cls.cache_dir, stage, cls.keys[stage] + ".npz")
+
+  @classmethod
+  def has(cls, stage):
+    if not (cls.active and os.path.isfile(cls.get_path(stage))):
+      return False
+    if not Record.active:
+      return True
+    with np.load(cls.get_path(stage), allow_pickle=False) as data:
+      # entries from before stats were flagged count as stored without them
+      return "__recorded__" in data.files and bool(data["__recorded__"])
+
+  @classmethod
+  def load(cls, stage):
+    '''
+    Returns the cached outputs of **stage** as a dict of arrays,
+    or None if they aren't cached.
+    '''
+    if not cls.has(stage):
+      return None
+
+    with np.load(cls.get_path(stage), allow_pickle=False) as data:
+      outputs = { name: data[name] for name in data.files }
+
+    outputs.pop("__recorded__", None)
+    stats = json.loads(str(outputs.pop("__stats__")))
+    for key, value in stats.items():
+      Record.record(key, value)
+
+    print("==> Loaded %s from stage cache." % stage)
+    return outputs
+
+  @classmethod
+  def save(cls, stage, outputs, stats={}):
+    if not cls.active:
+      return
+
+    path = cls.get_path(stage)
+    ensure_dir_exists(os.path.dirname(path))
+
+    # write to a temporary file first, so that a concurrent reader (or a
+    # crash halfway through) never sees a partially written cache entry
+    tmp_path = "%s.%s.tmp.npz" % (path[:-len(".npz")], os.getpid())
+    np.savez(tmp_path, __stats__=np.array(json.dumps(stats)),
+             __recorded__=np.array(Record.active), **outputs)
+    os.replace(tmp_path, path)
+
+  @classmethod
+  def fetch(cls, stage, compute):
+    '''
+    Returns the outputs of **stage**, loading them from the cache if
+    possible. Otherwise calls **compute**, which should return a dict of
+    arrays, and caches its result.
+    '''
+    outputs = cls.load(stage)
+    if outputs is not None:
+      return outputs
+
+    outputs, stats = Record.collect(compute)
+
+    cls.save(stage, outputs, stats)
+    return outputs
+
+def corners_to_array(corners):
+  return np.array([ corners[name] for name in CORNER_NAMES ])
+
+def array_to_corners(array):
+  return { name: tuple(int(v) for v in array[i]) for i, name in enumerate(CORNER_NAMES) }
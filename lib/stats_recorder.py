@@ -1,16 +1,67 @@
 import json
+import threading
 
 class Record:
+  '''
+  The stats of a run, exported as json at the end of it.
+
+  Stats can also be collected into sinks (see collect), e.g. so that
+  StageCache can store the stats a stage records with its outputs. Sinks
+  belong to the thread that opens them, so stages running concurrently
+  on other threads don't leak their stats into each other's sinks.
+  '''
   active = False
   stats = {}
+  local = threading.local()
+  lock = threading.Lock()
 
   @classmethod
   def activate(cls):
     cls.active = True
 
+  @classmethod
+  def reset(cls):
+    cls.stats = {}
+
   @classmethod
   def record(cls, key, value):
-    cls.stats[key] = value
+    with cls.lock:
+      cls.stats[key] = value
+    for sink in cls.get_sinks():
+      sink[key] = value
+
+  @classmethod
+  def get_sinks(cls):
+    '''
+    Returns the sinks open on this thread, innermost last.
+    '''
+    if not hasattr(cls.local, "sinks"):
+      cls.local.sinks = []
+    return cls.local.sinks
+
+  @classmethod
+  def set_sinks(cls, sinks):
+    '''
+    Makes stats recorded on this thread go to **sinks**, opened on
+    another thread (see get_sinks), e.g. for the threads a stage starts.
+    '''
+    cls.local.sinks = list(sinks)
+
+  @classmethod
+  def collect(cls, function):
+    '''
+    Calls **function**, and returns its result along with a dict of the
+    stats recorded on this thread (and the threads it hands its sinks
+    to) while it ran.
+    '''
+    sink = {}
+    sinks = cls.get_sinks()
+    sinks.append(sink)
+    try:
+      result = function()
+    finally:
+      sinks.remove(sink)
+    return (result, sink)
 
   @classmethod
   def export_as_json(cls, filename):
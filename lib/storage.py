@@ -0,0 +1,53 @@
+'''
+Where the worker daemon (worker_daemon.py) gets scans from and puts
+metadata and logs. Every backend has the same three methods, so the
+daemon doesn't care whether it's talking to S3 or to a local directory.
+
+'''
+
+import os
+import shutil
+import subprocess
+
+from .dir import ensure_dir_exists
+
+class LocalStorage:
+  '''
+  Stand-in for S3 that reads scans from **scans_dir** and copies results
+  to **out_root**/<bucket_name>/<image_name>, like copy_to_s3.sh does
+  in dev mode.
+  '''
+  def __init__(self, scans_dir, out_root):
+    self.scans_dir = scans_dir
+    self.out_root = out_root
+
+  def download(self, image_name, path):
+    shutil.copyfile(os.path.join(self.scans_dir, image_name), path)
+
+  def upload(self, directory, bucket_name, image_name):
+    destination = os.path.join(self.out_root, bucket_name, image_name)
+    ensure_dir_exists(destination)
+    for filename in os.listdir(directory):
+      shutil.copy(os.path.join(directory, filename), destination)
+
+  def set_status(self, image_name, status):
+    pass
+
+class S3Storage:
+  '''
+  The production buckets, reached with the aws command line tool,
+  exactly as process_task.sh and copy_to_s3.sh reach them.
+  '''
+  scans_bucket = "WWSSN_Scans"
+  aws_options = ["--region", "us-east-1", "--profile", "seismo"]
+
+  def download(self, image_name, path):
+    subprocess.check_call(["aws", "s3", "cp", "s3://%s/%s" % (self.scans_bucket, image_name), path] +
+                          self.aws_options)
+
+  def upload(self, directory, bucket_name, image_name):
+    subprocess.check_call(["aws", "s3", "cp", "--recursive", directory,
+                           "s3://wwssn-%s/%s" % (bucket_name, image_name)] + self.aws_options)
+
+  def set_status(self, image_name, status):
+    subprocess.check_call(["sh", "set_seismo_status.sh", image_name, str(status)])
@@ -0,0 +1,160 @@
+'''
+Deterministic synthetic seismograms, for benchmarking.
+
+The images imitate a scanned WWSSN seismogram: a dark, slightly rotated
+record (the region of interest) on light paper, with bright traces that
+wander around evenly spaced meanlines, minute marks that lift each trace
+for a moment, and occasional large excursions that cross the
+neighboring traces.
+
+'''
+
+import numpy as np
+from numpy.random import RandomState
+from scipy.ndimage import gaussian_filter
+import skimage.draw as skidraw
+
+# dimensions of a full-size (scale = 1) scan
+FULL_SIZE_SHAPE = (5952, 15452)
+
+PARAMS = {
+  # margins of paper around the record, as fractions of the image size.
+  # These give the record the area quality_control expects.
+  "margins": { "top": 0.14, "bottom": 0.09, "left": 0.035, "right": 0.045 },
+  "rotation": 0.004, # radians
+  "trace-width": lambda scale: max(2.0, 12*scale),
+  "minute-mark-height": lambda scale: 14*scale,
+  "minute-mark-width": lambda scale: 20*scale,
+  "minutes-per-trace": 60,
+  "paper-intensity": 0.8,
+  "record-intensity": 0.08,
+  "trace-intensity": 0.85
+}
+
+def get_trace_offsets(random, num_columns, amplitude, crossing_density, spacing, scale):
+  '''
+  Returns the vertical offset of a trace from its meanline at every column,
+  in pixels. **spacing** is the distance between neighboring meanlines.
+  '''
+  x = np.arange(num_columns, dtype=float)
+  offsets = np.zeros(num_columns)
+
+  # background motion: a few slow swells and a fast, small wiggle
+  for i in range(4):
+    wavelength = random.uniform(300, 3000) * scale
+    offsets += random.uniform(0.2, 1) * amplitude * \
+               np.sin(2 * np.pi * x / wavelength + random.uniform(0, 2 * np.pi))
+  wiggle_wavelength = random.uniform(14, 22) * scale
+  offsets += 0.3 * amplitude * np.sin(2 * np.pi * x / wiggle_wavelength)
+
+  # events: damped oscillations large enough to cross other traces
+  num_events = random.poisson(crossing_density)
+  for i in range(num_events):
+    onset = random.uniform(0, num_columns)
+    size = random.uniform(1, 3) * spacing * random.choice([-1, 1])
+    period = random.uniform(40, 400) * scale
+    decay = random.uniform(2, 8) * period
+    t = np.clip(x - onset, 0, None)
+    offsets += np.where(x >= onset, size * np.exp(-t / decay) * np.sin(2 * np.pi * t / period), 0)
+
+  return offsets
+
+def get_minute_marks(num_columns, scale):
+  '''
+  Returns the upward offset caused by the minute marks at every column.
+  '''
+  period = num_columns / float(PARAMS["minutes-per-trace"])
+  width = max(1, int(PARAMS["minute-mark-width"](scale)))
+  marks = (np.arange(num_columns) % period) < width
+  return marks * PARAMS["minute-mark-height"](scale)
+
+def draw_trace(image, rows, cols, width, intensity):
+  '''
+  Draws a trace through (rows[i], cols[i]), filling in every row between
+  consecutive points so that steep parts of the trace stay connected.
+  '''
+  top = np.minimum(rows[:-1], rows[1:]) - width / 2.0
+  bottom = np.maximum(rows[:-1], rows[1:]) + width / 2.0
+  top = np.clip(np.floor(top).astype(int), 0, image.shape[0])
+  bottom = np.clip(np.ceil(bottom).astype(int), 0, image.shape[0])
+  cols = cols[:-1]
+
+  for offset in range(int((bottom - top).max())):
+    inside = top + offset < bottom
+    image[top[inside] + offset, cols[inside]] = intensity
+
+def generate_seismogram(scale=1, num_traces=24, amplitude=1, crossing_density=0.5,
+                        noise=0.02, seed=0):
+  '''
+  Generates a synthetic seismogram.
+
+  Parameters
+  ------------
+  scale : float
+    1 for a full-size seismogram, 0.25 for quarter-size, etc.
+  num_traces : int
+    Number of traces (and meanlines) in the record.
+  amplitude : float
+    Size of the ordinary motion of the traces around their meanlines,
+    in multiples of the trace width.
+  crossing_density : float
+    Average number of large excursions per trace. Each one
+    crosses one to three neighboring traces.
+  noise : float
+    Standard deviation of the gaussian noise added to the image.
+  seed : int
+    Seed of the random number generator. The same parameters and seed
+    always give the same image.
+
+  Returns
+  --------
+  image : 2-D numpy array of uint8
+  truth : dict
+    The "roi" corners (as (x, y) tuples, like get_roi) and, for every
+    meanline, the row at which it crosses the left and right edges of the
+    record ("meanlines").
+  '''
+  random = RandomState(seed)
+  shape = (int(FULL_SIZE_SHAPE[0] * scale), int(FULL_SIZE_SHAPE[1] * scale))
+  image = np.full(shape, PARAMS["paper-intensity"])
+
+  # the record: a rotated rectangle
+  margins = PARAMS["margins"]
+  top, bottom = margins["top"] * shape[0], (1 - margins["bottom"]) * shape[0]
+  left, right = margins["left"] * shape[1], (1 - margins["right"]) * shape[1]
+  tilt = np.tan(PARAMS["rotation"])
+  center_x = (left + right) / 2
+  corners = {
+    "top_left": (left, top + tilt * (left - center_x)),
+    "top_right": (right, top + tilt * (right - center_x)),
+    "bottom_right": (right, bottom + tilt * (right - center_x)),
+    "bottom_left": (left, bottom + tilt * (left - center_x))
+  }
+  corner_list = [ corners[name] for name in ["top_left", "top_right", "bottom_right", "bottom_left"] ]
+  rr, cc = skidraw.polygon([ y for (x, y) in corner_list ], [ x for (x, y) in corner_list ], shape)
+  image[rr, cc] = PARAMS["record-intensity"]
+
+  # the traces
+  cols = np.arange(int(left), int(right))
+  width = PARAMS["trace-width"](scale)
+  spacing = (bottom - top) / (num_traces + 1)
+  minute_marks = get_minute_marks(len(cols), scale)
+  meanlines = []
+  for i in range(num_traces):
+    meanline = top + (i + 1) * spacing + tilt * (cols - center_x)
+    offsets = get_trace_offsets(random, len(cols), amplitude * width, crossing_density,
+                                spacing, scale)
+    rows = meanline + offsets - minute_marks
+    draw_trace(image, rows, cols, width, PARAMS["trace-intensity"])
+    meanlines.append((float(meanline[0]), float(meanline[-1])))
+
+  # the scan: slight blur, then sensor noise
+  image = gaussian_filter(image, sigma=max(0.5, 2 * scale))
+  image += random.normal(0, noise, shape)
+  image = (255 * np.clip(image, 0, 1)).astype(np.uint8)
+
+  truth = {
+    "roi": { name: (int(round(x)), int(round(y))) for name, (x, y) in corners.items() },
+    "meanlines": meanlines
+  }
+  return image, truth
@@ -7,19 +7,21 @@ Created on Fri Feb 13 13:05:12 2015
 
 from lib.timer import timeStart, timeEnd
 from lib.debug import Debug
+from lib.precision import Precision
 
 import numpy as np
 from scipy.interpolate import SmoothBivariateSpline as spline2d
-from scipy.ndimage import distance_transform_edt
-from skimage.morphology import (convex_hull_image)
+from scipy.spatial import ConvexHull, QhullError
 from numpy.ma.core import MaskedArray
-from .mitchells_best_candidate import best_candidate_sample
+from .mitchells_best_candidate import best_candidate_sample_from_mask
+from .block_histograms import IntegralHistogram
+from .quantized_image import QuantizedImage, quantize
 from .utilities import local_min
 
 generator = Debug.random
 
 def threshold(img, threshold_function, num_blocks, block_dims = None,
-        smoothing = 0.003):
+        smoothing = 0.003, max_deviation = 0.1):
   '''
   Get a smoothly varying threshold from an image by applying the threshold
   function to multiple randomly positioned blocks of the image and using
@@ -31,7 +33,11 @@ def threshold(img, threshold_function, num_blocks, block_dims = None,
     The grayscale image.
   threshold_function : a function
     The threshold function should take a grayscale image as an input and
-    output an int or float.
+    output an int or float. If it has a from_histogram attribute (like the
+    functions made by make_background_thresh_fun), the blocks are read off
+    an integral histogram of the image instead (see ThresholdSurface),
+    which makes the cost of the blocks almost independent of their number
+    and size.
   num_blocks : int
     The number of blocks within the image to which to apply the threshold
     function. A higher number will provide better coverage across the
@@ -45,34 +51,27 @@ def threshold(img, threshold_function, num_blocks, block_dims = None,
     A parameter to adjust the smoothness of the 2-D smoothing spline. A
     higher number increases the smoothness of the output. An input of zero
     is equivalent to interpolation.
+  max_deviation : float, optional
+    The spline is evaluated on a coarse grid and interpolated bilinearly
+    between the grid points. The grid is refined until the interpolation
+    is within this many gray levels (1/255 of the range of a float image)
+    of the spline. Zero evaluates the spline at every pixel.
 
   Returns
   ---------
   th_new : 2-D numpy array
     The threshold. The array is the same shape as the original input image.
   '''
-  img_dims = img.shape
-  if num_blocks >= 16:
-    spline_order = 3
-  else:
-    spline_order = int(np.sqrt(num_blocks) - 1)
+  if hasattr(threshold_function, "from_histogram"):
+    surface = ThresholdSurface(img, num_blocks, block_dims, smoothing, max_deviation)
+    return surface.get_surface(threshold_function)
+
+  spline_order = get_spline_order(num_blocks)
   if spline_order == 0:
     return (np.ones_like(img) * threshold_function(img))
 
-  if (type(img) is MaskedArray):
-    mask = img.mask
-  else:
-    mask = np.zeros(img_dims, dtype=bool)
-
-  candidate_coords = np.transpose(np.nonzero(~mask))
-
-  if block_dims is None:
-    block_dim = int(round(np.sqrt(2 * img.size / num_blocks)))
-    block_dims = (block_dim, block_dim)
-
-  timeStart("select block centers")
-  points = best_candidate_sample(candidate_coords, num_blocks)
-  timeEnd("select block centers")
+  block_dims = get_block_dims(img, num_blocks, block_dims)
+  points = select_block_centers(img, num_blocks)
 
   def get_threshold_for_block(center):
     block = get_block(img, center, block_dims)
@@ -81,22 +80,212 @@ def threshold(img, threshold_function, num_blocks, block_dims = None,
     else:
       return threshold_function(block)
 
-  timeStart("calculate thresholds for blocks of size %s" % block_dim)
+  timeStart("calculate thresholds for blocks of size %s" % block_dims[0])
   thresholds = np.asarray([ get_threshold_for_block(center) for center in points ])
-  timeEnd("calculate thresholds for blocks of size %s" % block_dim)
+  timeEnd("calculate thresholds for blocks of size %s" % block_dims[0])
+
+  return fit_threshold_surface(points, thresholds, img.shape, spline_order,
+                               smoothing, block_dims, max_deviation * get_gray_level(img))
+
+class ThresholdSurface:
+  '''
+  The blocks of an image that threshold() applies threshold functions to,
+  sampled once, with their histograms. Each threshold made from them
+  (see background, foreground and get_surface) costs one spline fit.
+  background_threshold, foreground_threshold and flatten_background each
+  make one threshold from a surface of their own. Code that needs several
+  thresholds of the same image can make a ThresholdSurface and ask it
+  for each of them instead.
+
+  Takes the same parameters as threshold().
+
+  Attributes
+  -------------
+  shape : tuple
+    The dimensions of the image.
+  points : 2-D numpy array
+    The centers of the blocks.
+  histograms : 2-D numpy array
+    The 256-bin histogram of each block (of the whole image, if there are
+    too few blocks to fit a spline).
+  bin_edges : 1-D numpy array
+  '''
+  def __init__(self, img, num_blocks = None, block_dims = None,
+               smoothing = 0.003, max_deviation = 0.1):
+    # Default number of blocks assumes 500x500 blocks are a good size
+    if num_blocks is None:
+      num_blocks = int(np.ceil(2 * img.size / 250000))
+
+    self.shape = img.shape
+    self.smoothing = smoothing
+    self.max_deviation = max_deviation * get_gray_level(img)
+    self.spline_order = get_spline_order(num_blocks)
+    self.block_dims = get_block_dims(img, num_blocks, block_dims)
+
+    if self.spline_order == 0:
+      quantized = QuantizedImage.of(img)
+      self.points = None
+      self.bin_edges = quantized.bin_edges
+      self.histograms = quantized.get_histogram()[np.newaxis]
+      return
+
+    self.points = select_block_centers(img, num_blocks)
+
+    timeStart("build integral histogram")
+    integral = IntegralHistogram(img, cell_size=max(1, min(self.block_dims) // 10))
+    timeEnd("build integral histogram")
+
+    timeStart("collect histograms of blocks of size %s" % self.block_dims[0])
+    self.bin_edges = integral.bin_edges
+    self.histograms = np.array([ integral.get_block_histogram(center, self.block_dims)
+                                 for center in self.points ])
+    timeEnd("collect histograms of blocks of size %s" % self.block_dims[0])
+
+  def get_surface(self, threshold_function):
+    '''
+    Returns the threshold made by applying **threshold_function** (which
+    must have a from_histogram attribute, like the functions made by
+    make_background_thresh_fun) to every block.
+    '''
+    thresholds = np.asarray([ threshold_function.from_histogram(hist, self.bin_edges)
+                              for hist in self.histograms ])
+    if self.spline_order == 0:
+      return np.full(self.shape, thresholds[0], dtype=Precision.float_dtype)
+
+    return fit_threshold_surface(self.points, thresholds, self.shape, self.spline_order,
+                                 self.smoothing, self.block_dims, self.max_deviation)
 
+  def background(self, prob_background = 1):
+    '''
+    See background_threshold.
+    '''
+    return self.get_surface(make_background_thresh_fun(prob_background))
+
+  def foreground(self, prob_foreground = 0.99):
+    '''
+    See foreground_threshold.
+    '''
+    return self.get_surface(make_foreground_thresh_fun(prob_foreground))
+
+def get_spline_order(num_blocks):
+  if num_blocks >= 16:
+    return 3
+  else:
+    return int(np.sqrt(num_blocks) - 1)
+
+def get_block_dims(img, num_blocks, block_dims = None):
+  if block_dims is None:
+    block_dim = int(round(np.sqrt(2 * img.size / num_blocks)))
+    block_dims = (block_dim, block_dim)
+  return block_dims
+
+def get_gray_level(img):
+  '''
+  Returns the difference between adjacent gray levels in **img**.
+  '''
+  return (1 / 255) if np.amax(img) <= 1 else 1
+
+def select_block_centers(img, num_blocks):
+  if (type(img) is MaskedArray):
+    mask = img.mask
+  else:
+    mask = np.zeros(img.shape, dtype=bool)
+
+  timeStart("select block centers")
+  points = best_candidate_sample_from_mask(mask, num_blocks)
+  timeEnd("select block centers")
+  return points
+
+def fit_threshold_surface(points, thresholds, img_dims, spline_order, smoothing,
+                          block_dims, max_deviation):
+  '''
+  Fits a 2-D smoothing spline to the **thresholds** of the blocks centered
+  at **points**, and evaluates it across an image of shape **img_dims**
+  (see evaluate_spline).
+  '''
   timeStart("fit 2-D spline")
   # Maybe consider using lower-order spline for large images
   # (if large indices create problems for cubic functions)
   fit = spline2d(points[:,0], points[:,1], thresholds,
                  bbox = [0, img_dims[0], 0, img_dims[1]],
                  kx = spline_order, ky = spline_order,
-                 s = num_blocks * smoothing)
-  th_new = fit(x = np.arange(img_dims[0]), y = np.arange(img_dims[1]))
-  th_new = fix_border(th_new, points)
+                 s = len(points) * smoothing)
+  hull = get_convex_hull(points)
+  th_new = evaluate_spline(fit, hull, img_dims, max(1, min(block_dims) // 10),
+                           max_deviation)
   timeEnd("fit 2-D spline")
   return th_new
 
+def get_grid_coords(length, step):
+  '''
+  Returns every **step**-th index of an axis of length **length**,
+  always including the last one.
+  '''
+  coords = np.arange(0, length, step)
+  if coords[-1] != length - 1:
+    coords = np.append(coords, length - 1)
+  return coords
+
+def interpolate_axis(values, coords, length, axis):
+  '''
+  Linearly interpolates **values**, sampled at the indices **coords**
+  along **axis**, at every index from 0 to **length** - 1.
+  '''
+  if len(coords) == 1:
+    return np.repeat(values, length, axis=axis)
+
+  positions = np.arange(length)
+  upper = np.clip(np.searchsorted(coords, positions, side="right"), 1, len(coords) - 1)
+  lower = upper - 1
+  weights = (positions - coords[lower]) / (coords[upper] - coords[lower])
+  weights = weights.astype(values.dtype).reshape((-1, 1) if axis == 0 else (1, -1))
+
+  interpolated = np.take(values, lower, axis=axis)
+  difference = np.take(values, upper, axis=axis)
+  difference -= interpolated
+  difference *= weights
+  interpolated += difference
+  return interpolated
+
+def evaluate_spline(fit, hull, img_dims, step, max_deviation):
+  '''
+  Evaluates the 2-D spline **fit**, with its border fixed outside the
+  convex polygon **hull** (see fix_border), at every pixel of an image of
+  shape **img_dims**, by evaluating it every **step** pixels and
+  interpolating bilinearly in between. A smoothing spline varies slowly
+  over a few pixels, so this gives nearly the same surface for a fraction
+  of the spline evaluations and full-size float64 temporaries.
+
+  The interpolation is compared with the surface at the centers of all
+  the grid cells, where bilinear interpolation is furthest from the
+  corners it interpolates, and the grid is halved until the largest
+  difference is at most **max_deviation**. Cells that cross the edge of
+  the hull, where the surface has a crease, usually need a finer grid
+  than the spline inside it does. Debug runs print the grid step and the
+  difference.
+  '''
+  step = int(step) if max_deviation > 0 else 1
+  while True:
+    rows = get_grid_coords(img_dims[0], step)
+    cols = get_grid_coords(img_dims[1], step)
+    grid, _ = fix_border(fit, hull, rows, cols)
+    if step == 1:
+      deviation = 0
+      break
+
+    centers, _ = fix_border(fit, hull, (rows[:-1] + rows[1:]) / 2, (cols[:-1] + cols[1:]) / 2)
+    interpolated = (grid[:-1, :-1] + grid[1:, :-1] + grid[:-1, 1:] + grid[1:, 1:]) / 4
+    deviation = np.abs(centers - interpolated).max()
+    if deviation <= max_deviation:
+      break
+    step = step // 2
+
+  if Debug.active:
+    print("spline evaluated every %s pixels, max deviation %.3g" % (step, deviation))
+  grid = Precision.as_float(grid)
+  return interpolate_axis(interpolate_axis(grid, rows, img_dims[0], 0),
+                          cols, img_dims[1], 1)
+
 def debug_blocks(img, points, block_dims, threshold_function):
   '''
   To be used for debugging. Saves images of blocks that throw errors,
@@ -199,26 +388,102 @@ def get_block(img, center, block_dims):
     block = img[upper:lower, left:right]
     return block
 
-def get_convex_hull(points, img_dims):
+def get_convex_hull(points):
   '''
   Given an array containing the coordinates of points in a 2-D array, outputs
-  the convex hull of those points.
+  the vertices of the convex hull of those points, in counterclockwise
+  order. Like skimage's convex_hull_image, the hull is that of the
+  midpoints of the edges of the points' pixels.
+  '''
+  offsets = np.array([[-0.5, 0], [0.5, 0], [0, -0.5], [0, 0.5]])
+  coords = (np.asarray(points, dtype=float)[:, np.newaxis, :] + offsets).reshape((-1, 2))
+  try:
+    return coords[ConvexHull(coords).vertices]
+  except QhullError:
+    # all of the points lie on one row or column
+    order = np.lexsort((coords[:,1], coords[:,0]))
+    return coords[[order[0], order[-1]]]
+
+def nearest_in_hull(hull, coords):
+  '''
+  Returns the point of the convex polygon **hull** (see get_convex_hull)
+  closest to each row of **coords**. Points inside the hull are their own
+  nearest point.
   '''
-  img = np.zeros(img_dims, dtype = bool)
-  img[points[:,0], points[:,1]] = True
-  return convex_hull_image(img)
+  starts = hull
+  edges = np.roll(hull, -1, axis=0) - starts
+
+  # a point is inside a counterclockwise polygon if it's left of every edge
+  inside = np.ones(len(coords), dtype=bool) if len(hull) > 2 else np.zeros(len(coords), dtype=bool)
+  for start, edge in zip(starts, edges):
+    inside &= edge[0] * (coords[:,1] - start[1]) - edge[1] * (coords[:,0] - start[0]) >= 0
+
+  # otherwise the closest point lies on the closest edge
+  nearest = coords.copy()
+  outside = coords[~inside]
+  offsets = outside[:, np.newaxis, :] - starts[np.newaxis, :, :]
+  lengths = np.maximum((edges ** 2).sum(axis=1), np.finfo(float).tiny)
+  t = np.clip((offsets * edges).sum(axis=2) / lengths, 0, 1)
+  projections = starts + t[:,:,np.newaxis] * edges
+  distances = ((outside[:, np.newaxis, :] - projections) ** 2).sum(axis=2)
+  nearest[~inside] = projections[np.arange(len(outside)), np.argmin(distances, axis=1)]
+  return nearest
+
+def fix_border(fit, hull, rows, cols):
+  '''
+  Evaluates the 2-D spline **fit** on the grid of **rows** and **cols**
+  within the convex polygon **hull** of the sample points. Everywhere
+  outside the hull, the value is that of the spline at the nearest point
+  of the hull, since the spline is unreliable where it has no samples.
+  The nearest points are found analytically, for the grid points alone.
 
-def fix_border(spline, sample_points):
+  Returns
+  --------
+  values : 2-D numpy array
+  inside : 2-D numpy array of bools
+    The grid points inside the hull.
   '''
-  Given coordinates of points in a 2-D array, finds the convex hull defined
-  by those points. Outputs an image equal to spline within the convex hull
-  and, everywhere outside the hull, equal to the value of the nearest point
-  inside the hull.
+  values = fit(x = rows, y = cols)
+  inside = np.zeros(values.shape, dtype=bool)
+  # a few rows at a time, so the grid can be dense without the
+  # points-by-edges arrays getting large
+  band = max(1, 65536 // len(cols))
+  for start in range(0, len(rows), band):
+    band_rows = rows[start:start + band]
+    coords = np.stack(np.meshgrid(band_rows, cols, indexing="ij"), axis=-1) \
+               .reshape((-1, 2)).astype(float)
+    nearest = nearest_in_hull(hull, coords)
+    outside = (nearest != coords).any(axis=1)
+    band_values = values[start:start + band].ravel()
+    band_values[outside] = fit.ev(nearest[outside, 0], nearest[outside, 1])
+    values[start:start + band] = band_values.reshape((len(band_rows), len(cols)))
+    inside[start:start + band] = ~outside.reshape((len(band_rows), len(cols)))
+  return (values, inside)
+
+def get_hist(img):
   '''
-  border = (~ get_convex_hull(sample_points, spline.shape))
-  ind = distance_transform_edt(border, return_distances = False,
-                 return_indices = True)
-  return spline[tuple(ind)]
+  Returns a histogram of all (unmasked) pixel values for a grayscale image.
+
+  Parameters
+  ------------
+  img : 2-D numpy array
+    The grayscale image. Can be either floats on the interval [0,1] or
+    ints on the interval [0,255].
+
+  Returns
+  --------
+  hist, bin_edges : 1-D numpy arrays
+    The histogram bin values and edges.
+  '''
+  levels, mask, bin_edges = quantize(img)
+  if mask is not None:
+    levels = levels[~mask]
+
+  # Assume that data from 256,000 pixels is sufficient
+  if levels.size > 256 * 1000:
+    prob = float(256 * 1000) / levels.size
+    levels = levels[(generator.random_sample(size = levels.shape) < prob)]
+  return (np.bincount(levels.ravel(), minlength = 256), bin_edges)
 
 def get_hist_and_background_count(img):
   '''
@@ -237,18 +502,14 @@ def get_hist_and_background_count(img):
     The histogram bin values and edges, and the expected distribution of values
     for background (i.e. non-trace) pixels.
   '''
-  if np.amax(img) <= 1:
-    bins = np.linspace(0, 256/255, num = 257)
-    img = np.round(255 * img) / 255
-  else:
-    bins = np.arange(257)
-
-  # Assume that data from 256,000 pixels is sufficient
-  if img.size > 256 * 1000:
-    prob = float(256 * 1000) / img.size
-    img = img[(generator.random_sample(size = img.shape) < prob)]
-  hist_counts, bin_edges = np.histogram(img, bins = bins)
+  hist_counts, bin_edges = get_hist(img)
+  return get_background_count(hist_counts, bin_edges)
 
+def get_background_count(hist_counts, bin_edges):
+  '''
+  Like get_hist_and_background_count, but starting from a histogram
+  (e.g. one read off an IntegralHistogram).
+  '''
   # Pad counts with 1 (to eliminate zeros)
   hist_counts = hist_counts + 1
 
@@ -303,13 +564,17 @@ def make_background_thresh_fun(prob_background = 1):
       The threshold below which pixels in the image are likely part of the
       background.
     '''
-    hist, bin_edges, background_count = get_hist_and_background_count(img)
+    return get_background_thresh_from_hist(*get_hist(img))
+
+  def get_background_thresh_from_hist(hist, bin_edges):
+    hist, bin_edges, background_count = get_background_count(hist, bin_edges)
     probabilities = np.minimum(background_count / hist, 0.99)
     peak_pixel_color = get_most_common_background_pixel_color(hist)
     probabilities[0:(peak_pixel_color + 1)] = 1
     th = bin_edges[np.argmin(probabilities >= prob_background) - 1]
     return th
 
+  get_background_thresh.from_histogram = get_background_thresh_from_hist
   return get_background_thresh
 
 def make_foreground_thresh_fun(prob_foreground = 0.99):
@@ -339,11 +604,15 @@ def make_foreground_thresh_fun(prob_foreground = 0.99):
       The threshold above which pixels in the image are likely part of the
       foreground.
     '''
-    hist, bin_edges, background_count = get_hist_and_background_count(img)
+    return get_foreground_thresh_from_hist(*get_hist(img))
+
+  def get_foreground_thresh_from_hist(hist, bin_edges):
+    hist, bin_edges, background_count = get_background_count(hist, bin_edges)
     probabilities = 1 - np.minimum(background_count / hist, 1)
     th = bin_edges[np.argmax(probabilities >= prob_foreground)]
     return th
 
+  get_foreground_thresh.from_histogram = get_foreground_thresh_from_hist
   return get_foreground_thresh
 
 def background_threshold(img, prob_background = 1, num_blocks = None,
@@ -376,14 +645,8 @@ def background_threshold(img, prob_background = 1, num_blocks = None,
     The varying threshold that separates the dark background from the rest
     of the image. Has the same size and dimensions as img.
   '''
-  # Default number of blocks assumes 500x500 blocks are a good size
-  if num_blocks is None:
-    num_blocks = int(np.ceil(2 * img.size / 250000))
-
-  get_background_thresh = make_background_thresh_fun(prob_background)
-
-  return threshold(img, get_background_thresh, num_blocks, block_dims,
-                   smoothing=0.003)
+  surface = ThresholdSurface(img, num_blocks, block_dims, smoothing=0.003)
+  return surface.background(prob_background)
 
 def foreground_threshold(img, prob_foreground = 0.99, num_blocks = None,
              block_dims = None):
@@ -415,14 +678,8 @@ def foreground_threshold(img, prob_foreground = 0.99, num_blocks = None,
     The varying threshold that separates the bright foreground from the
     rest of the image. Has the same size and dimensions as img.
   '''
-  # Default number of blocks assumes 500x500 blocks are a good size
-  if num_blocks is None:
-    num_blocks = int(np.ceil(2 * img.size / 250000))
-
-  get_foreground_thresh = make_foreground_thresh_fun(prob_foreground)
-
-  return threshold(img, get_foreground_thresh, num_blocks, block_dims,
-                   smoothing=0.003)
+  surface = ThresholdSurface(img, num_blocks, block_dims, smoothing=0.003)
+  return surface.foreground(prob_foreground)
 
 def flatten_background(img, prob_background = 1, num_blocks = None,
              block_dims = None, return_background = False, img_gray = None):
@@ -458,15 +715,10 @@ def flatten_background(img, prob_background = 1, num_blocks = None,
   background : 2-D numpy array of bools
     The pixels below the background threshold.
   '''
-  # Default number of blocks assumes 500x500 blocks are a good size
-  if num_blocks is None:
-    num_blocks = int(np.ceil(2 * img.size / 250000))
-
-  timeStart("calculate background threshold with %s blocks" % num_blocks)
-  get_background_thresh = make_background_thresh_fun(prob_background)
-  background_level = threshold(img, get_background_thresh, num_blocks,
-                               block_dims, smoothing=0.003)
-  timeEnd("calculate background threshold with %s blocks" % num_blocks)
+  timeStart("calculate background threshold")
+  surface = ThresholdSurface(img, num_blocks, block_dims, smoothing=0.003)
+  background_level = surface.background(prob_background)
+  timeEnd("calculate background threshold")
 
   timeStart("select dark pixels")
   dark_pixels = img < background_level
@@ -0,0 +1,219 @@
+'''
+Tiled execution of the ridge detection and binarization stages.
+
+The image is cut into tiles, each tile is padded with a halo of
+neighboring pixels, and the tiles are processed in a pool of worker
+processes. Only the un-padded core of each tile's result is kept, so as
+long as the halo is at least as wide as the reach of the stage, the
+stitched result matches the result for the whole image. Ridge detection
+has a bounded reach; binarization doesn't (see binary_image_tiled).
+
+'''
+
+from lib.timer import timeStart, timeEnd
+from lib.debug import Debug
+from lib.feature_bank import FeatureBank
+from lib.precision import Precision
+
+import numpy as np
+from math import sqrt
+from multiprocessing import get_context, cpu_count
+
+from .ridge_detection import find_ridges, get_sigma_list, get_slope_threshold, get_ridge_params
+from .binarization import binary_image
+
+def get_tiles(shape, tile_size, halo):
+  '''
+  Splits an image of dimensions **shape** into square tiles.
+
+  Returns
+  --------
+  tiles : list of tuples
+    For each tile, a tuple (outer, inner, core) of pairs of slices.
+    outer is the tile plus its halo, in image coordinates. core is the
+    tile without its halo, in image coordinates, and inner is the same
+    region in the coordinates of the outer tile.
+  '''
+  tiles = []
+  for row in range(0, shape[0], tile_size):
+    for col in range(0, shape[1], tile_size):
+      core = (slice(row, min(row + tile_size, shape[0])),
+              slice(col, min(col + tile_size, shape[1])))
+      outer = (slice(max(0, core[0].start - halo), min(shape[0], core[0].stop + halo)),
+               slice(max(0, core[1].start - halo), min(shape[1], core[1].stop + halo)))
+      inner = (slice(core[0].start - outer[0].start, core[0].stop - outer[0].start),
+               slice(core[1].start - outer[1].start, core[1].stop - outer[1].start))
+      tiles.append((outer, inner, core))
+  return tiles
+
+def get_ridge_halo(min_sigma, max_sigma, sigma_ratio, min_ridge_length, max_scales=None):
+  '''
+  The width of the halo needed for find_ridges to give the same result
+  in the core of a tile as it does for the whole image.
+  '''
+  largest_sigma = get_sigma_list(min_sigma, max_sigma, sigma_ratio, max_scales)[-1]
+  # gaussian_filter1d truncates its kernel at 4 standard deviations,
+  # and the maxima search looks one more pixel beyond that
+  blur_radius = int(4 * largest_sigma + 0.5) + 1
+  # a horizontal ridge blocks out vertical ridges up to sqrt(2) * sigma
+  # away, and vertical ridges survive if they're connected to
+  # min_ridge_length other ridge pixels
+  ridge_reach = max(int(round(sqrt(2) * largest_sigma)), min_ridge_length)
+  return blur_radius + ridge_reach
+
+def get_binary_halo(min_sigma, max_sigma, sigma_ratio, min_ridge_length, max_scales=None):
+  '''
+  The width of the halo binary_image_tiled uses, twice the ridge halo.
+
+  The watershed has no fixed reach, so this is not a bound, just a
+  margin: a basin grows from a ridge marker about as far as the widest
+  trace the ridge scales are made for. With it, 150 to 1024 pixel tiles
+  of the sample seismogram at scale 0.25 binarize exactly like the whole
+  image, while the ridge halo alone (51 pixels) changes a few dozen.
+  '''
+  return 2 * get_ridge_halo(min_sigma, max_sigma, sigma_ratio, min_ridge_length, max_scales)
+
+def init_worker(compact):
+  # Debug images of individual tiles would just be noise,
+  # and workers would race on the debug image counter
+  Debug.set_directory(None)
+  # workers don't inherit the settings of the process that starts them
+  Precision.set_compact(compact)
+
+def run_tiles(function, arrays, tiles, num_processes, args):
+  if num_processes is None:
+    num_processes = cpu_count()
+
+  tasks = [ ([ a[outer] for a in arrays ], inner, args) for (outer, inner, core) in tiles ]
+
+  # The pipeline runs stages on threads, and forking a process while
+  # other threads hold locks (in numpy, logging, FeatureBank, ...) can
+  # deadlock the child. The workers are forked from a single-threaded
+  # server instead, which imports this module once for all of them.
+  context = get_context("forkserver")
+  context.set_forkserver_preload(["lib.tiling"])
+  pool = context.Pool(processes=num_processes, initializer=init_worker,
+                      initargs=(Precision.compact,))
+  try:
+    results = pool.map(function, tasks, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+  return results
+
+def get_ridge_data_in_core(ridge_data, inner):
+  '''
+  Keeps the rows of **ridge_data** (as find_ridges(figures=False) returns
+  it for a tile) that lie in the core of the tile.
+  '''
+  rows, cols = ridge_data[:, 0], ridge_data[:, 1]
+  in_core = ((rows >= inner[0].start) & (rows < inner[0].stop) &
+             (cols >= inner[1].start) & (cols < inner[1].stop))
+  return ridge_data[in_core]
+
+def find_ridges_in_tile(task):
+  (img, dark_pixels), inner, kwargs = task
+  if kwargs.get("figures", True):
+    ridges_h, ridges_v = find_ridges(img, dark_pixels, **kwargs)
+    return (ridges_h[inner], ridges_v[inner])
+  else:
+    ridge_data_h, ridge_data_v = find_ridges(img, dark_pixels, **kwargs)
+    return (get_ridge_data_in_core(ridge_data_h, inner),
+            get_ridge_data_in_core(ridge_data_v, inner))
+
+def stitch_ridge_data(tiles, tile_data):
+  '''
+  Moves the ridge data of every tile to image coordinates, and sorts it
+  in row-major order, like find_ridges lists it for the whole image.
+  '''
+  ridge_data = []
+  for (outer, inner, core), data in zip(tiles, tile_data):
+    data = data.copy()
+    data[:, 0] += outer[0].start
+    data[:, 1] += outer[1].start
+    ridge_data.append(data)
+  ridge_data = np.vstack(ridge_data)
+  return ridge_data[np.lexsort((ridge_data[:, 1], ridge_data[:, 0]))]
+
+def find_ridges_tiled(img, dark_pixels, num_processes=None, tile_size=1024, **kwargs):
+  '''
+  Equivalent to find_ridges(img, dark_pixels, **kwargs), but
+  runs on overlapping tiles in a pool of **num_processes** processes.
+  '''
+  params = get_ridge_params(**{ name: kwargs[name] for name in
+                               ["scale", "min_sigma", "max_sigma", "sigma_ratio",
+                                "min_ridge_length", "max_scales"] if name in kwargs })
+  # the tiles already keep every core busy
+  kwargs.setdefault("num_threads", 1)
+  halo = get_ridge_halo(params["min_sigma"], params["max_sigma"], params["sigma_ratio"],
+                        params["min_ridge_length"], params["max_scales"])
+
+  timeStart("get slope thresholds for the whole image")
+  # the slope thresholds are Otsu thresholds, which depend on
+  # the whole image, so each tile has to be given them
+  kwargs["slope_thresholds"] = (get_slope_threshold(img, axis=1),
+                                get_slope_threshold(img, axis=0))
+  # tiled binarization filters each tile itself
+  FeatureBank.release("sobel-axis", img, axis=0)
+  FeatureBank.release("sobel-axis", img, axis=1)
+  timeEnd("get slope thresholds for the whole image")
+
+  tiles = get_tiles(img.shape, tile_size, halo)
+
+  timeStart("find ridges in %s tiles with a %s pixel halo" % (len(tiles), halo))
+  results = run_tiles(find_ridges_in_tile, [img, dark_pixels], tiles,
+                      num_processes, kwargs)
+  timeEnd("find ridges in %s tiles with a %s pixel halo" % (len(tiles), halo))
+
+  if not kwargs.get("figures", True):
+    return (stitch_ridge_data(tiles, [ tile_h for tile_h, tile_v in results ]),
+            stitch_ridge_data(tiles, [ tile_v for tile_h, tile_v in results ]))
+
+  ridges_h = np.zeros(img.shape, dtype=bool)
+  ridges_v = np.zeros(img.shape, dtype=bool)
+  for (outer, inner, core), (tile_h, tile_v) in zip(tiles, results):
+    ridges_h[core] = tile_h
+    ridges_v[core] = tile_v
+
+  return (ridges_h, ridges_v)
+
+def binary_image_in_tile(task):
+  (image, markers_trace, markers_background), inner, kwargs = task
+  image_bin = binary_image(image, markers_trace=markers_trace,
+                           markers_background=markers_background, **kwargs)
+  return image_bin[inner]
+
+def binary_image_tiled(image, markers_trace, markers_background,
+                       num_processes=None, tile_size=1024, halo=None,
+                       scale=1, max_scales=None, **kwargs):
+  '''
+  Approximately binary_image(image, markers_trace, markers_background,
+  **kwargs), run on overlapping tiles in a pool of **num_processes**
+  processes.
+
+  Unlike the ridges, the watershed has no fixed reach: a basin can in
+  principle flood arbitrarily far from its marker, so a tile can
+  binarize pixels near its edge differently than the whole image does.
+  By default **halo** comes from get_binary_halo for the ridge scales of
+  **scale** and **max_scales**, which is wide enough for the tiles to
+  agree with the whole image on the sample seismogram, but nothing
+  guarantees it for every image.
+  '''
+  if halo is None:
+    params = get_ridge_params(scale=scale, max_scales=max_scales)
+    halo = get_binary_halo(params["min_sigma"], params["max_sigma"], params["sigma_ratio"],
+                           params["min_ridge_length"], params["max_scales"])
+  tiles = get_tiles(image.shape, tile_size, halo)
+
+  timeStart("binarize %s tiles with a %s pixel halo" % (len(tiles), halo))
+  results = run_tiles(binary_image_in_tile,
+                      [image, markers_trace, markers_background], tiles,
+                      num_processes, kwargs)
+  timeEnd("binarize %s tiles with a %s pixel halo" % (len(tiles), halo))
+
+  image_bin = np.zeros(image.shape, dtype=bool)
+  for (outer, inner, core), tile_bin in zip(tiles, results):
+    image_bin[core] = tile_bin
+
+  return image_bin
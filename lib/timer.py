@@ -1,48 +1,212 @@
+import json
+import os
+import resource
 import sys
-from time import time
-
-timeDict = {}
-depth = 0
+import threading
+from time import time, thread_time
+
+class Span:
+  '''
+  One timed section of the pipeline, opened by timeStart and closed
+  by timeEnd.
+
+  Attributes
+  -------------
+  name : string
+  parent : Span or None
+    The innermost span that was open when this one started.
+  depth : int
+    Number of enclosing spans.
+  thread : int
+    Identifier of the thread the span ran on.
+  start : float
+    Wall-clock time the span started, in seconds since the epoch.
+  wall_time : float
+    Seconds elapsed between start and end.
+  cpu_time : float
+    Seconds of CPU time the span's thread spent between start and end.
+  peak_rss_delta : float
+    How much the peak resident set size of the process grew during the
+    span, in megabytes. Concurrent spans share one process, so their
+    deltas can overlap.
+  '''
+  def __init__(self, name, parent):
+    self.name = name
+    self.parent = parent
+    self.depth = 0 if parent is None else parent.depth + 1
+    self.thread = threading.current_thread().ident
+    self.start = time()
+    self.wall_time = None
+    self.cpu_time = None
+    self.peak_rss_delta = None
+
+    self._cpu_start = thread_time()
+    self._peak_rss_start = get_peak_rss()
+
+  def end(self):
+    self.wall_time = time() - self.start
+    self.cpu_time = thread_time() - self._cpu_start
+    self.peak_rss_delta = get_peak_rss() - self._peak_rss_start
+
+def get_peak_rss():
+  # ru_maxrss is in kilobytes on linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class Tracer:
+  '''
+  Keeps every span timed since the last reset, so a run can be exported
+  as a Chrome trace (load it in chrome://tracing or Perfetto) or
+  summarized per pipeline stage.
+
+  Each thread has its own stack of open spans, so spans of stages that run
+  concurrently nest correctly, and a span may enclose another of the
+  same name.
+  '''
+
+  spans = []
+  local = threading.local()
+  lock = threading.Lock()
+
+  @classmethod
+  def reset(cls):
+    with cls.lock:
+      cls.spans = []
+
+  @classmethod
+  def get_stack(cls):
+    if not hasattr(cls.local, "stack"):
+      cls.local.stack = []
+    return cls.local.stack
+
+  @classmethod
+  def get_current(cls):
+    '''
+    Returns the innermost open span of this thread, or None.
+    '''
+    stack = cls.get_stack()
+    return stack[-1] if stack else getattr(cls.local, "root", None)
+
+  @classmethod
+  def set_root(cls, span):
+    '''
+    Makes **span**, opened on another thread, the parent of spans
+    opened on this thread while it has no open spans of its own.
+    '''
+    cls.local.root = span
+
+  @classmethod
+  def start(cls, name):
+    stack = cls.get_stack()
+    span = Span(name, cls.get_current())
+    stack.append(span)
+    with cls.lock:
+      cls.spans.append(span)
+    return span
+
+  @classmethod
+  def end(cls, name):
+    stack = cls.get_stack()
+    # close the innermost open span with this name, along with
+    # any spans opened inside it that were never closed
+    for i in range(len(stack) - 1, -1, -1):
+      if stack[i].name == name:
+        break
+    else:
+      raise KeyError("No open span named %s" % name)
+
+    for span in reversed(stack[i:]):
+      span.end()
+    del stack[i:]
+    return span
+
+  @classmethod
+  def get_stage_summary(cls, prefix="stage "):
+    '''
+    Returns a dict mapping the name of every span that starts with
+    **prefix** (without the prefix) to its wall time, CPU time and peak
+    RSS delta. If a span name occurs more than once, the times are summed
+    and the largest peak RSS delta is kept.
+    '''
+    summary = {}
+    for span in cls.spans:
+      if span.wall_time is None or not span.name.startswith(prefix):
+        continue
+      entry = summary.setdefault(span.name[len(prefix):], {
+        "wall_time": 0.0, "cpu_time": 0.0, "peak_rss_delta": 0.0
+      })
+      entry["wall_time"] += span.wall_time
+      entry["cpu_time"] += span.cpu_time
+      entry["peak_rss_delta"] = max(entry["peak_rss_delta"], span.peak_rss_delta)
+
+    for entry in summary.values():
+      for key in entry:
+        entry[key] = float("%.4f" % entry[key])
+    return summary
+
+  @classmethod
+  def export_chrome_trace(cls, filename):
+    '''
+    Saves every closed span as a complete ("X") event in the Chrome
+    trace-event format, with times in microseconds since the first span.
+    '''
+    spans = [ span for span in cls.spans if span.wall_time is not None ]
+    origin = min([ span.start for span in spans ] or [0])
+    pid = os.getpid()
+
+    events = []
+    for span in spans:
+      events.append({
+        "name": span.name,
+        "ph": "X",
+        "pid": pid,
+        "tid": span.thread,
+        "ts": (span.start - origin) * 1e6,
+        "dur": span.wall_time * 1e6,
+        "args": {
+          "cpu_time": span.cpu_time,
+          "peak_rss_delta_mb": span.peak_rss_delta,
+          "parent": None if span.parent is None else span.parent.name
+        }
+      })
+
+    with open(filename, "w") as f:
+      json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
 
 # keep track of whether timers are being nested
 timer_open = False
 
 def timeStart(key):
-  global depth, timer_open
+  global timer_open
 
-  timeDict[key] = time()
+  span = Tracer.start(key)
 
-  printStart(key, timer_open)
+  printStart(key, span.depth, timer_open)
 
-  depth += 1
   timer_open = True
 
 def timeEnd(key):
-  global depth, timer_open
+  global timer_open
 
-  depth -= 1
+  span = Tracer.end(key)
 
-  time_elapsed = time() - timeDict[key]
-  del timeDict[key]
-  
-  printEnd(key, time_elapsed, timer_open)
+  printEnd(key, span.depth, span.wall_time, timer_open)
 
   timer_open = False
 
-  return time_elapsed
+  return span.wall_time
 
-def printStart(key, timer_open):
+def printStart(key, depth, timer_open):
   if (timer_open is True):
     sys.stdout.write("\n")
 
-  sys.stdout.write(getIndent() + key + " ... ")
+  sys.stdout.write(getIndent(depth) + key + " ... ")
   sys.stdout.flush()
 
-def printEnd(key, time_elapsed, timer_open):
+def printEnd(key, depth, time_elapsed, timer_open):
   if (timer_open is False):
-    sys.stdout.write(getIndent())
+    sys.stdout.write(getIndent(depth))
 
   sys.stdout.write(str(time_elapsed) + "s \n")
 
-def getIndent():
+def getIndent(depth):
   return ''.join(["  " for i in range(depth)])
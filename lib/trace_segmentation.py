@@ -8,18 +8,21 @@ Created on Wed Feb 25 13:58:26 2015
 from lib.timer import timeStart, timeEnd
 from lib.debug import Debug
 from lib.stats_recorder import Record
+from lib.precision import Precision
 
 import numpy as np
 from skimage.morphology import (medial_axis, binary_erosion, square)
 from skimage.segmentation import watershed
 from scipy.ndimage import label
 from skimage import color
-from skimage.filters import sobel, threshold_otsu
+from skimage.filters import sobel
 from skimage.feature import canny
 
 from .reverse_medial_axis import reverse_medial_axis
 from .binarization import fill_corners
 from .segment import segment
+from .sparse_ridges import SparseRidges
+from .quantized_image import get_otsu_threshold
 from geojson import FeatureCollection
 
 def get_segments(img_gray, img_bin, img_skel, dist, img_intersections,
@@ -53,7 +56,7 @@ def get_segments(img_gray, img_bin, img_skel, dist, img_intersections,
   Debug.save_image("segments", "slopes", image_sobel)
 
   timeStart("otsu threshold")
-  steep_slopes = image_sobel > threshold_otsu(image_sobel)
+  steep_slopes = image_sobel > get_otsu_threshold(image_sobel)
   timeEnd("otsu threshold")
 
   Debug.save_image("segments", "steep_slopes", steep_slopes)
@@ -83,6 +86,7 @@ def get_segments(img_gray, img_bin, img_skel, dist, img_intersections,
   # the pixels values of rmat_dist correspond to the distance
   # between each pixel and its nearest foreground/background boundary
   _, rmat_dist = medial_axis(rmat, return_distance=True)
+  rmat_dist = Precision.as_float(rmat_dist)
   timeEnd("get distance transform")
 
   Debug.save_image("segments", "distance_transform", rmat_dist)
@@ -162,6 +166,10 @@ def img_seg_to_seg_objects(img_seg, num_segments, ridges_h, ridges_v, img_gray):
   ------------
   img_seg : 2-D numpy array of ints
     An array with each pixel labeled according to its segment.
+  ridges_h : SparseRidges or 2-D boolean numpy array
+    The horizontal ridges, as pixel lists or as an image.
+  ridges_v : SparseRidges or 2-D boolean numpy array
+    The vertical ridges, as pixel lists or as an image.
 
   Returns
   --------
@@ -204,13 +212,23 @@ def img_seg_to_seg_objects(img_seg, num_segments, ridges_h, ridges_v, img_gray):
 
   timeEnd("get segment coordinates")
 
+  timeStart("get ridge coordinates of segments")
+  if not isinstance(ridges_h, SparseRidges):
+    ridges_h = SparseRidges.from_image(ridges_h)
+  if not isinstance(ridges_v, SparseRidges):
+    ridges_v = SparseRidges.from_image(ridges_v)
+  ridge_h_coordinates = ridges_h.split_by_label(img_seg, num_segments)
+  ridge_v_coordinates = ridges_v.split_by_label(img_seg, num_segments)
+  timeEnd("get ridge coordinates of segments")
+
   segments = {}
   timeStart("create segment objects")
   for (segment_idx, pixel_coords) in enumerate(segment_coordinates):
     segment_id = segment_idx + 1
     pixel_coords = np.array(pixel_coords)
     values = get_image_values(img_gray, pixel_coords)
-    ridge_line = get_ridge_line(ridges_h, ridges_v, pixel_coords)
+    ridge_line = ridges_to_centerline(ridge_h_coordinates[segment_idx],
+                                      ridge_v_coordinates[segment_idx])
     
     new_segment = segment(coords=pixel_coords,
                           values=np.array(values),
@@ -251,55 +269,9 @@ def segments_to_geojson(segments):
     [seg.to_geojson_feature() for seg in segments.values() if seg.has_center_line]
   return FeatureCollection(geojson_line_segments)
 
-def get_ridge_line(ridges_h, ridges_v, region):
-  '''
-  Parameters
-  ------------
-  ridges_h : 2-D boolean array
-    Image containing the horizontal ridge lines.
-  ridges_v : 2-D boolean array
-    Image containing the vertical ridge lines.
-  region : 2-D numpy array
-    A list of coordinates defining the region for which you want to
-    generate a center line.
-
-  Returns
-  ---------
-  ridge_line : 2-D numpy array
-    List of coordinates defining the center line of the region.
-
-  '''
-  ridge_h_coords = get_ridge_coords_in_region(ridges_h, region)
-  ridge_v_coords = get_ridge_coords_in_region(ridges_v, region)
-  ridge_line = ridges_to_centerline(ridge_h_coords, ridge_v_coords)
-  return ridge_line
-
 def get_image_values(img_gray, coords):
   return [int(255*img_gray[tuple(pt)]) for pt in coords]
 
-def get_ridge_coords_in_region(ridges, coord_list):
-  '''
-  Filter through a list of coordinates, returning only those
-  that correspond to a true value in **ridges**.
-
-  Parameters
-  ------------
-  ridges : 2-D boolean array
-    The image containing the ridge lines.
-  coord_list : 2-D numpy array
-    The coordinates that you want to filter through.
-
-  Returns
-  ---------
-  ridge_coords : numpy array
-    The subset of coordinates in **coord_list** that correspond
-    to ridges.
-  
-  '''
-  coord_is_a_ridge = ridges[coord_list[:,0], coord_list[:,1]]
-  ridge_coords = coord_list[coord_is_a_ridge]
-  return ridge_coords
-
 def ridges_to_centerline(ridge_h_coords, ridge_v_coords):
   '''
   After corresponding with Benamy, it sounds like the purpose
@@ -6,11 +6,13 @@ Created on Tue Feb 17 11:54:50 2015
 """
 
 from lib.timer import timeStart, timeEnd
+from lib.precision import Precision
 
 import numpy as np
 from skimage.draw import disk
 from scipy.stats import percentileofscore
 from skimage.morphology import dilation, erosion
+from lib.quantized_image import QuantizedImage
 # from threshold import make_background_thresh_fun
 
 def encode_labeled_image_as_rgb(labeled_image):
@@ -42,8 +44,7 @@ def decode_rgb_to_labeled_image(rgb_image):
   return r * 256 * 256 + g * 256 + b
 
 def local_min(image, min_distance=2):
-  if np.amax(image) <= 1:
-    image = np.uint8(image * 255)
+  image = QuantizedImage.of(image).levels
 
   selem = np.ones((2 * min_distance + 1, 2 * min_distance + 1))
 
@@ -54,8 +55,7 @@ def local_min(image, min_distance=2):
   return image == img
 
 def local_max(image, min_distance=2):
-  if np.amax(image) <= 1:
-    image = np.uint8(image * 255)
+  image = QuantizedImage.of(image).levels
   selem = np.ones((2 * min_distance + 1, 2*min_distance + 1))
   img = dilation(image, selem)
   return image == img
@@ -66,7 +66,7 @@ def normalize(a):
   elements and then divides all elements by the resulting maximum. All
   elements in the returned array are in the interval [0,1].
   '''
-  b = (a - np.amin(a)).astype(float)
+  b = (a - np.amin(a)).astype(Precision.float_dtype)
   b /= np.amax(b)
   return b
 
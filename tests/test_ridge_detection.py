@@ -0,0 +1,65 @@
+'''
+Tests of the ridge maxima search (see ridge_detection.get_layer_maxima).
+
+get_layer_maxima used to stack three layers of the image cube and run
+maximum_filter over them with a (3,1,3) or (1,3,3) footprint. The tests
+compare it with that version.
+
+'''
+
+import numpy as np
+import pytest
+from scipy.ndimage import maximum_filter
+
+from lib import ridge_detection
+from lib.ridge_detection import get_layer_maxima, find_ridges
+from lib.synthetic_seismogram import generate_seismogram
+
+# the neighbors of a pixel lie along the axis of the blur
+FOOTPRINTS = {
+  0: np.ones((3, 1, 3), dtype=bool),
+  1: np.ones((1, 3, 3), dtype=bool)
+}
+
+def get_layer_maxima_with_filter(below, layer, above, axis):
+  window = np.stack((below, layer, above), axis=-1)
+  return maximum_filter(window, footprint=FOOTPRINTS[axis], mode="nearest")[:, :, 1]
+
+def get_layers(shape, levels=None, dtype=np.float64, seed=0):
+  '''
+  Three random layers, rounded to **levels** values if given, so that
+  they're full of plateaus and ties.
+  '''
+  rng = np.random.default_rng(seed)
+  layers = rng.random((3,) + shape)
+  if levels is not None:
+    layers = np.floor(layers * levels)
+  return [ layer.astype(dtype) for layer in layers ]
+
+@pytest.mark.parametrize("axis", [0, 1])
+@pytest.mark.parametrize("shape", [(40, 60), (1, 50), (50, 1), (1, 1), (2, 3)])
+@pytest.mark.parametrize("levels", [None, 3])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_layer_maxima_match_maximum_filter(axis, shape, levels, dtype):
+  below, layer, above = get_layers(shape, levels, dtype)
+  maxima = get_layer_maxima(below, layer, above, axis)
+  assert maxima.dtype == dtype
+  np.testing.assert_array_equal(maxima, get_layer_maxima_with_filter(below, layer, above, axis))
+
+def test_layer_maxima_of_constant_layers():
+  below, layer, above = [ np.full((5, 7), 0.25) for _ in range(3) ]
+  for axis in [0, 1]:
+    np.testing.assert_array_equal(get_layer_maxima(below, layer, above, axis), layer)
+
+def test_ridges_match_maximum_filter(monkeypatch):
+  image, _ = generate_seismogram(scale=0.1, num_traces=6, seed=1)
+  img = 1 - image[:200, :300] / 255
+  dark_pixels = np.zeros(img.shape, dtype=bool)
+
+  ridges_h, ridges_v = find_ridges(img, dark_pixels, scale=0.1, num_threads=1)
+  assert ridges_h.any() and ridges_v.any()
+
+  monkeypatch.setattr(ridge_detection, "get_layer_maxima", get_layer_maxima_with_filter)
+  expected_h, expected_v = find_ridges(img, dark_pixels, scale=0.1, num_threads=1)
+  np.testing.assert_array_equal(ridges_h, expected_h)
+  np.testing.assert_array_equal(ridges_v, expected_v)
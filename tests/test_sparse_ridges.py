@@ -0,0 +1,70 @@
+'''
+Tests of the ridge pixel lists (see sparse_ridges.SparseRidges).
+
+'''
+
+import numpy as np
+
+from lib import trace_segmentation
+from lib.sparse_ridges import SparseRidges
+from lib.trace_segmentation import img_seg_to_seg_objects
+
+def get_ridges_and_labels(seed, shape=(30, 40), num_labels=5):
+  rng = np.random.default_rng(seed)
+  ridges = rng.random(shape) < 0.2
+  labels = rng.integers(0, num_labels + 1, shape)
+  return (ridges, labels, num_labels)
+
+def test_from_image_round_trip():
+  for seed in range(5):
+    ridges, _, _ = get_ridges_and_labels(seed)
+    sparse = SparseRidges.from_image(ridges)
+    assert len(sparse) == ridges.sum()
+    np.testing.assert_array_equal(sparse.to_image(), ridges)
+
+def test_split_by_label_matches_dense_indexing():
+  for seed in range(5):
+    ridges, labels, num_labels = get_ridges_and_labels(seed)
+    coords = SparseRidges.from_image(ridges).split_by_label(labels, num_labels)
+    for label in range(1, num_labels + 1):
+      # the ridge pixels of the segment's pixels, in row-major order
+      pixels = np.argwhere(labels == label)
+      expected = pixels[ridges[pixels[:, 0], pixels[:, 1]]]
+      np.testing.assert_array_equal(coords[label - 1].reshape((-1, 2)), expected)
+
+def get_ridge_data(ridges, seed):
+  '''
+  The pixels of **ridges** as find_ridges(figures=False) lists them, with
+  made up sigmas and max values, in shuffled order.
+  '''
+  rng = np.random.default_rng(seed)
+  coords = np.argwhere(ridges)
+  ridge_data = np.column_stack((coords, rng.random((len(coords), 2))))
+  return ridge_data[rng.permutation(len(ridge_data))]
+
+def test_segments_from_dense_and_sparse_ridges(monkeypatch):
+  ridges_h, labels, num_labels = get_ridges_and_labels(0)
+  ridges_v, _, _ = get_ridges_and_labels(1)
+  img_gray = np.random.default_rng(2).random(labels.shape)
+
+  # the ridge pixels each segment's centerline is made from
+  calls = []
+  def ridges_to_centerline(ridge_h_coords, ridge_v_coords):
+    calls.append((ridge_h_coords.reshape((-1, 2)), ridge_v_coords.reshape((-1, 2))))
+    return np.zeros((0, 2))
+  monkeypatch.setattr(trace_segmentation, "ridges_to_centerline", ridges_to_centerline)
+
+  img_seg_to_seg_objects(labels, num_labels, ridges_h, ridges_v, img_gray)
+  img_seg_to_seg_objects(labels, num_labels,
+                         SparseRidges(get_ridge_data(ridges_h, 3), labels.shape),
+                         SparseRidges(get_ridge_data(ridges_v, 4), labels.shape), img_gray)
+
+  assert len(calls) == 2 * num_labels
+  for label in range(1, num_labels + 1):
+    # what indexing the ridge images with the segment's pixels gave
+    pixels = np.argwhere(labels == label)
+    expected_h = pixels[ridges_h[pixels[:, 0], pixels[:, 1]]]
+    expected_v = pixels[ridges_v[pixels[:, 0], pixels[:, 1]]]
+    for ridge_h_coords, ridge_v_coords in [calls[label - 1], calls[num_labels + label - 1]]:
+      np.testing.assert_array_equal(ridge_h_coords, expected_h)
+      np.testing.assert_array_equal(ridge_v_coords, expected_v)
@@ -0,0 +1,74 @@
+'''
+Tests of the stage cache (see stage_cache.StageCache).
+
+'''
+
+import numpy as np
+import pytest
+
+from lib.pipeline import Pipeline, Stage
+from lib.stage_cache import StageCache
+from lib.stats_recorder import Record
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+  '''
+  A StageCache in a temporary directory, keyed off a small image file,
+  with Record and StageCache restored afterwards.
+  '''
+  monkeypatch.setattr(StageCache, "cache_dir", None)
+  monkeypatch.setattr(StageCache, "active", False)
+  monkeypatch.setattr(StageCache, "keys", {})
+  monkeypatch.setattr(Record, "active", False)
+  monkeypatch.setattr(Record, "stats", {})
+
+  image_file = tmp_path / "image.png"
+  image_file.write_bytes(b"not really an image")
+  StageCache.set_directory(str(tmp_path / "cache"))
+  StageCache.set_image(str(image_file))
+  StageCache.register("roi", { "scale": 1 })
+  return StageCache
+
+def run_roi(calls):
+  '''
+  Runs a pipeline with a cached roi stage that records a stat, like the
+  real roi stage, only when Record is active.
+  '''
+  def roi(img):
+    calls.append(img)
+    if Record.active:
+      Record.record("roi_area", 42)
+    return img * 2
+
+  pipeline = Pipeline([ Stage("roi", roi, ["img"], ["roi_corners"], cached=True) ])
+  return pipeline.run({ "img": np.arange(4) }, ["roi_corners"], num_threads=1)
+
+def test_stats_come_back_after_run_without_stats(cache):
+  calls = []
+  run_roi(calls)
+  assert len(calls) == 1
+  assert Record.stats == {}
+
+  # the entry was stored without stats, so it's computed again
+  Record.activate()
+  values = run_roi(calls)
+  assert len(calls) == 2
+  assert Record.stats == { "roi_area": 42 }
+  np.testing.assert_array_equal(values["roi_corners"], np.arange(4) * 2)
+
+  # and stored with them, so the stats are replayed from the cache
+  Record.reset()
+  values = run_roi(calls)
+  assert len(calls) == 2
+  assert Record.stats == { "roi_area": 42 }
+  np.testing.assert_array_equal(values["roi_corners"], np.arange(4) * 2)
+
+def test_entry_with_stats_serves_run_without_stats(cache):
+  calls = []
+  Record.activate()
+  run_roi(calls)
+
+  Record.active = False
+  values = run_roi(calls)
+  assert len(calls) == 1
+  np.testing.assert_array_equal(values["roi_corners"], np.arange(4) * 2)
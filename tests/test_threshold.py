@@ -0,0 +1,84 @@
+'''
+Tests of the threshold surface's border (see threshold.fix_border).
+
+fix_border used to be computed for every pixel, from skimage's
+convex_hull_image of the sample points and the indices of
+scipy's distance_transform_edt. The tests compare the analytic
+version with that one.
+
+'''
+
+import numpy as np
+from scipy.interpolate import SmoothBivariateSpline as spline2d
+from scipy.ndimage import distance_transform_edt
+from skimage.morphology import convex_hull_image
+
+from lib.threshold import get_convex_hull, nearest_in_hull, fix_border
+
+IMG_DIMS = (240, 360)
+
+# Outside the hull, the pixel hull of convex_hull_image is a staircase
+# along shallow edges, so the nearest pixel can slide a few pixels along
+# the edge from the nearest point of the hull. The surfaces can differ by
+# as much as the spline changes over that many pixels.
+MAX_SLIDE = 8
+
+def get_surface(seed):
+  '''
+  A smoothing spline through thresholds sampled at random points of the
+  middle of the image, like fit_threshold_surface fits, and the points.
+  '''
+  rng = np.random.default_rng(seed)
+  points = np.column_stack((rng.integers(40, IMG_DIMS[0] - 40, 150),
+                            rng.integers(50, IMG_DIMS[1] - 50, 150)))
+  thresholds = 0.5 + 0.1 * np.sin(points[:, 0] / 80) * np.cos(points[:, 1] / 100) + \
+               rng.normal(0, 0.005, len(points))
+  fit = spline2d(points[:, 0], points[:, 1], thresholds,
+                 bbox = [0, IMG_DIMS[0], 0, IMG_DIMS[1]], kx = 3, ky = 3,
+                 s = len(points) * 0.003)
+  return (fit, points)
+
+def fix_border_with_pixel_hull(fit, points):
+  '''
+  fix_border as it was, on a convex_hull_image of the points.
+  '''
+  img = np.zeros(IMG_DIMS, dtype=bool)
+  img[points[:, 0], points[:, 1]] = True
+  hull_image = convex_hull_image(img)
+  indices = distance_transform_edt(~hull_image, return_distances=False,
+                                   return_indices=True)
+  values = fit(x = np.arange(IMG_DIMS[0]), y = np.arange(IMG_DIMS[1]))
+  return (values[tuple(indices)], hull_image, indices)
+
+def get_steepest_step(fit, hull_image):
+  '''
+  The largest change of the spline between adjacent pixels of the hull.
+  '''
+  values = fit(x = np.arange(IMG_DIMS[0]), y = np.arange(IMG_DIMS[1]))
+  return max(np.abs(np.diff(values, axis=0))[hull_image[1:] & hull_image[:-1]].max(),
+             np.abs(np.diff(values, axis=1))[hull_image[:, 1:] & hull_image[:, :-1]].max())
+
+def test_fix_border_matches_pixel_hull():
+  for seed in range(6):
+    fit, points = get_surface(seed)
+    expected, hull_image, _ = fix_border_with_pixel_hull(fit, points)
+    values, inside = fix_border(fit, get_convex_hull(points),
+                                np.arange(IMG_DIMS[0]), np.arange(IMG_DIMS[1]))
+
+    # both hulls are made of the midpoints of the edges of the points'
+    # pixels, and the spline is left alone inside them
+    np.testing.assert_array_equal(inside, hull_image)
+    np.testing.assert_allclose(values[inside], expected[inside], rtol=0, atol=1e-12)
+    assert np.abs(values - expected).max() <= MAX_SLIDE * get_steepest_step(fit, hull_image)
+
+def test_nearest_in_hull_is_no_farther_than_nearest_pixel():
+  fit, points = get_surface(0)
+  _, hull_image, indices = fix_border_with_pixel_hull(fit, points)
+
+  coords = np.argwhere(~hull_image).astype(float)
+  nearest = nearest_in_hull(get_convex_hull(points), coords)
+  nearest_pixel = indices[:, ~hull_image].T
+  distance = np.sqrt(((nearest - coords) ** 2).sum(axis=1))
+  pixel_distance = np.sqrt(((nearest_pixel - coords) ** 2).sum(axis=1))
+  # the pixels of the pixel hull all lie in the polygon
+  assert (distance <= pixel_distance + 1e-9).all()
@@ -0,0 +1,46 @@
+'''
+Tests of the worker daemon's task loop (see worker_daemon.run).
+
+'''
+
+import os
+import threading
+
+import get_all_metadata_batch
+import worker_daemon
+from lib.storage import LocalStorage
+
+def analyze_or_die(task):
+  '''
+  Stands in for analyze_task. Kills its worker process on scans named
+  crash, like the kernel does to a worker that runs out of memory.
+  '''
+  image_path = task[0]
+  if os.path.basename(image_path).startswith("crash"):
+    os._exit(1)
+  return "complete"
+
+def test_dead_worker_fails_its_task(tmp_path, monkeypatch):
+  monkeypatch.setattr(worker_daemon, "analyze_task", analyze_or_die)
+  monkeypatch.setattr(get_all_metadata_batch, "warm_up", lambda: None)
+
+  scans_dir = tmp_path / "scans"
+  scans_dir.mkdir()
+  image_names = ["first.png", "crash.png", "last.png"]
+  for image_name in image_names:
+    (scans_dir / image_name).write_bytes(b"scan")
+  storage = LocalStorage(str(scans_dir), str(tmp_path / "out"))
+
+  # the daemon used to wait forever on the dead worker's analysis
+  results = {}
+  def run():
+    results["statuses"] = worker_daemon.run(storage, image_names, prefetch=1, num_uploads=1)
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  thread.join(timeout=60)
+  assert not thread.is_alive(), "the daemon hung on a dead worker"
+
+  statuses = results["statuses"]
+  assert statuses == { "first.png": "complete", "crash.png": "failed", "last.png": "complete" }
+  with open(tmp_path / "out" / "logs" / "crash.png" / "log.txt") as log:
+    assert "worker process died" in log.read()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Description:
+  Process a queue of seismograms with one long-running python process,
+  instead of one process_task.sh per seismogram. While a seismogram is
+  being analyzed, the next <k> scans are downloaded in the background, and
+  the metadata and logs of finished seismograms are uploaded by a pool of
+  background threads, so the CPU never sits idle waiting for the network.
+
+  Tasks are read one image name per line (the format prepare_queue.js
+  takes) from <filename>, or from standard input if <filename> is -.
+  Each seismogram's metadata and log go to the metadata and logs
+  buckets, and its status (see queue-worker/status.js) is set when done.
+
+Usage:
+  worker_daemon.py --tasks <filename> [--storage <storage>] [--scans <directory>] [--output <directory>] [--prefetch <k>] [--uploads <n>] [--processes <n>] [--scale <scale>] [--preview]
+  worker_daemon.py -h | --help
+
+Options:
+  -h --help             Show this screen.
+  --tasks <filename>    File with one image name per line, or - for standard input.
+  --storage <storage>   Either s3 or local. [default: s3]
+  --scans <directory>   With local storage, read scans from <directory>.
+  --output <directory>  With local storage, save metadata and logs in <directory>/<bucket>/<image name>.
+  --prefetch <k>        Number of scans to download ahead of the one being analyzed. [default: 2]
+  --uploads <n>         Number of background upload threads. [default: 2]
+  --processes <n>       Number of seismograms to analyze at once. [default: 1]
+  --scale <scale>       1 for a full-size seismogram, 0.25 for quarter-size, etc. [default: 1]
+  --preview             Reject bad seismograms early (see get_all_metadata.py).
+
+"""
+
+from docopt import docopt
+
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr, nullcontext
+
+# see queue-worker/status.js
+STATUS_CODES = {
+  "failed": 2,
+  "complete": 3,
+  "problematic": 5
+}
+
+def read_tasks(filename):
+  # standard input isn't ours to close
+  with (nullcontext(sys.stdin) if filename == "-" else open(filename, "r")) as f:
+    for line in f:
+      image_name = line.strip()
+      if image_name:
+        yield image_name
+
+def analyze_task(task):
+  '''
+  Runs in a warm worker process. Everything the pipeline prints goes
+  to the seismogram's log.
+  '''
+  from get_all_metadata import analyze_image
+
+  image_path, out_dir, log_path, scale, preview, num_threads = task
+  with open(log_path, "w") as log, redirect_stdout(log), redirect_stderr(log):
+    try:
+      status = analyze_image(image_path, out_dir, out_dir + "/stats.json", scale,
+                             num_threads=num_threads, preview=preview)
+    except Exception:
+      traceback.print_exc()
+      status = "failed"
+  return status
+
+class Task:
+  '''
+  One seismogram on its way through the daemon. All of its files live
+  in a temporary directory that is deleted once they're uploaded.
+  '''
+  def __init__(self, image_name):
+    self.image_name = image_name
+    self.dir = tempfile.mkdtemp(prefix="seismo.")
+    self.image_path = os.path.join(self.dir, image_name)
+    self.metadata_dir = os.path.join(self.dir, "metadata")
+    self.log_dir = os.path.join(self.dir, "logs")
+    self.download = None
+    self.analysis = None
+    os.mkdir(self.metadata_dir)
+    os.mkdir(self.log_dir)
+
+  def get_log_path(self):
+    return os.path.join(self.log_dir, "log.txt")
+
+def upload_task(storage, task, status):
+  '''
+  Runs on an upload thread.
+  '''
+  try:
+    if status != "failed":
+      storage.upload(task.metadata_dir, "metadata", task.image_name)
+    storage.upload(task.log_dir, "logs", task.image_name)
+    storage.set_status(task.image_name, STATUS_CODES[status])
+  except Exception:
+    print("error uploading %s" % task.image_name)
+    traceback.print_exc()
+  finally:
+    shutil.rmtree(task.dir)
+
+def download_task(storage, task):
+  '''
+  Runs on a download thread.
+  '''
+  storage.download(task.image_name, task.image_path)
+
+def run(storage, image_names, prefetch=2, num_uploads=2, num_processes=1, scale=1,
+        preview=False):
+  '''
+  Analyzes every seismogram in **image_names** (any iterable, so tasks can
+  keep arriving while earlier ones are processed).
+
+  Returns
+  --------
+  statuses : dict
+    Maps each image name to "complete", "problematic", or "failed".
+  '''
+  from get_all_metadata_batch import warm_up, get_threads_per_process
+
+  image_names = iter(image_names)
+  statuses = {}
+  downloading = deque()
+  analyzing = []
+
+  download_pool = ThreadPoolExecutor(max_workers=max(1, prefetch))
+  upload_pool = ThreadPoolExecutor(max_workers=num_uploads)
+  # unlike multiprocessing.Pool, the executor notices when a worker
+  # process dies (e.g. killed for running out of memory) and fails its
+  # analyses with BrokenProcessPool, instead of leaving them pending
+  process_pool = ProcessPoolExecutor(max_workers=num_processes, initializer=warm_up)
+  num_threads = get_threads_per_process(num_processes)
+
+  def finish(task, status):
+    statuses[task.image_name] = status
+    print("WORKER>>>%s %s<<<" % (task.image_name, status))
+    sys.stdout.flush()
+    upload_pool.submit(upload_task, storage, task, status)
+
+  try:
+    while True:
+      # keep the analysis processes busy plus k scans in reserve
+      while len(downloading) < num_processes + prefetch:
+        image_name = next(image_names, None)
+        if image_name is None:
+          break
+        task = Task(image_name)
+        task.download = download_pool.submit(download_task, storage, task)
+        downloading.append(task)
+
+      while len(analyzing) < num_processes and downloading:
+        task = downloading.popleft()
+        try:
+          task.download.result()
+        except Exception:
+          with open(task.get_log_path(), "w") as log:
+            traceback.print_exc(file=log)
+          finish(task, "failed")
+          continue
+        task.analysis = process_pool.submit(analyze_task, (
+          task.image_path, task.metadata_dir, task.get_log_path(), scale, preview, num_threads
+        ))
+        analyzing.append(task)
+
+      if not analyzing:
+        break
+
+      # wait for any analysis to finish
+      done, _ = wait([ task.analysis for task in analyzing ], return_when=FIRST_COMPLETED)
+      broken = any(isinstance(analysis.exception(), BrokenProcessPool) for analysis in done)
+      if broken:
+        # a worker process died, and every analysis in the pool fails
+        # with it, since there's no telling which of them killed it
+        done, _ = wait([ task.analysis for task in analyzing ])
+
+      for task in [ task for task in analyzing if task.analysis in done ]:
+        analyzing.remove(task)
+        try:
+          status = task.analysis.result()
+        except BrokenProcessPool:
+          with open(task.get_log_path(), "a") as log:
+            log.write("\nA worker process died while this seismogram was being analyzed.\n")
+          status = "failed"
+        except Exception:
+          status = "failed"
+        finish(task, status)
+
+      if broken:
+        process_pool.shutdown(wait=True)
+        process_pool = ProcessPoolExecutor(max_workers=num_processes, initializer=warm_up)
+  finally:
+    process_pool.shutdown(wait=True)
+    download_pool.shutdown(wait=True)
+    upload_pool.shutdown(wait=True)
+
+  return statuses
+
+def get_storage(name, scans_dir, out_root):
+  from lib.storage import LocalStorage, S3Storage
+
+  if name == "local":
+    return LocalStorage(scans_dir, out_root)
+  elif name == "s3":
+    return S3Storage()
+  else:
+    raise ValueError("Unknown storage %s" % name)
+
+if __name__ == '__main__':
+  arguments = docopt(__doc__)
+  tasks_file = arguments["--tasks"]
+  storage_name = arguments["--storage"]
+  scans_dir = arguments["--scans"]
+  out_root = arguments["--output"]
+  prefetch = int(arguments["--prefetch"])
+  num_uploads = int(arguments["--uploads"])
+  num_processes = int(arguments["--processes"])
+  scale = float(arguments["--scale"])
+  preview = arguments["--preview"]
+
+  if storage_name == "local" and not (scans_dir and out_root):
+    print("--storage local needs --scans and --output")
+  elif tasks_file:
+    storage = get_storage(storage_name, scans_dir, out_root)
+    run(storage, read_tasks(tasks_file), prefetch, num_uploads, num_processes, scale, preview)
+  else:
+    print(arguments)